@@ -1,24 +1,89 @@
-from helpers.encode import jsto
-from database.sqlite import SQLite
+from helpers.encode import jotb, jsto, encode_cursor, decode_cursor
+from helpers.cache import ResponseCache, etag_matches
+from helpers.metrics import Metrics
+from database.sqlite import SQLite, BusyError
+from database.routed_sqlite import RoutedSQLite, check_placement
 from database.schemas import Schemas
+from database.backup import BackupScheduler
+from database.tags import TagIndex, TagSyntaxError
+from database.graph import GraphError, plan_graph, stub_refs, insert_graph
+from database.query import (QueryError, compile_aggregate, compile_filter,
+    project, MAX_IN)
 
-from fastapi import FastAPI
-from pydantic import BaseModel, create_model
+from fastapi import FastAPI, Query
+from pydantic import BaseModel, ValidationError as ModelError
 from starlette.requests import Request
-from starlette.responses import Response, RedirectResponse, JSONResponse
-from jsonschema import validate
+from starlette.responses import (Response, RedirectResponse, JSONResponse,
+    StreamingResponse)
 from jsonschema.exceptions import ValidationError
 
+from sqlite3 import Error as SQLiteError
 from typing import Any, Dict, List, Tuple, Union, Optional
 from enum import Enum
+from os import environ
+from time import perf_counter
 
 KeyedDict = Dict[str, Any]
 DataType = Tuple[Union[str, int, float, bool]]
-app = FastAPI()
-db = SQLite("x.db")
+"""
+Renders through helpers.encode instead of stdlib json. Routes returning large
+payloads build it directly, which also skips FastAPI's jsonable_encoder pass,
+and bytes are taken as already serialized JSON.
+
+e.g. return EncodedResponse(res)
+"""
+class EncodedResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, bytes):
+            return content
+
+        return jotb(content)
+
+app = FastAPI(default_response_class=EncodedResponse)
 schemas = Schemas()
+db_file = environ.get("EPICURE_DB", "x.db")
+
+# e.g. EPICURE_PLACEMENT="events:events.db,audit:audit.db"
+placement = dict()
+for pair in environ.get("EPICURE_PLACEMENT", "").split(","):
+    if ":" in pair:
+        table, table_file = pair.split(":", 1)
+        placement[table.strip()] = table_file.strip()
+
+check_placement(schemas, placement, db_file)
+db = RoutedSQLite(db_file, placement,
+    cached_statements=schemas.statement_count(),
+    group_commit=environ.get("EPICURE_GROUP_COMMIT", "0") == "1",
+    group_window=float(environ.get("EPICURE_GROUP_WINDOW", 0.002)),
+    group_size=int(environ.get("EPICURE_GROUP_SIZE", 64)),
+    busy_timeout=float(environ.get("EPICURE_BUSY_TIMEOUT", 5.0)),
+    retries=int(environ.get("EPICURE_BUSY_RETRIES", 5)))
+
+# Every gunicorn worker imports this module, only the first runs the DDL
+for table_file, shard in db.shards.items():
+    tables = [table for table in schemas.order()
+        if db.file(table) == table_file]
+    with shard.writer.init_lock():
+        schemas.create_tables(shard.writer, tables)
+
+db.refresh_catalog()
+
+metrics = Metrics(slow_threshold=float(environ.get("EPICURE_SLOW_QUERY",
+    0.1)))
+metrics.attach(db)
+
+responses = ResponseCache(
+    max_bytes=int(environ.get("EPICURE_CACHE_BYTES", 64 * 2 ** 20)),
+    max_entry=int(environ.get("EPICURE_CACHE_ENTRY", 2 ** 20)))
+tag_index = TagIndex(db, cached=environ.get("EPICURE_TAG_CACHE", "1") == "1")
 
-schemas.create_tables(db)
+backup_interval = environ.get("EPICURE_BACKUP_INTERVAL")
+backups = BackupScheduler([shard.writer for shard in db.shards.values()],
+    environ.get("EPICURE_BACKUP_DIR"),
+    interval=float(backup_interval) if backup_interval else None,
+    backups=int(environ.get("EPICURE_BACKUPS", 3)))
 models = schemas.generate_models()
 
 # DEBUG
@@ -27,15 +92,6 @@ models = schemas.generate_models()
 #    for field_name, field_type in model.__annotations__.items():
 #        print("\t", field_name, field_type, model.__fields__.get(field_name))
 
-# Inject dynamic models in as variables
-dynamic_fields = dict()
-for name, model in models.items():
-    model_name = model.__name__
-    globals()[model_name] = model
-    dynamic_fields[name] = (model, None)
-
-DynamicEntry = create_model("DynamicEntry", **dynamic_fields)
-
 #SchemaName = Enum("SchemaName", {key: key for key in models.keys()})
 
 class Entry(BaseModel):
@@ -43,98 +99,325 @@ class Entry(BaseModel):
 
 class GetEntry(Entry):
     table: str
-    select: List[str]
+    select: Optional[List[str]] = None
+    filter: Optional[KeyedDict] = None
+    limit: Optional[int] = None
+    cursor: Optional[str] = None
 
 class PutEntry(Entry):
     table: str
     value: KeyedDict
 
+def touch(table: str):
+    responses.bump(table)
+    if table in ("tagmap", "tags", "notes"):
+        tag_index.invalidate()
+
+def cached(request: Request, key: Tuple, stamp: Tuple) -> Optional[Response]:
+    hit = responses.get(key, stamp)
+    if hit is None:
+        return None
+
+    etag, body = hit
+    return etag_response(request, etag, body)
+
+def cache(request: Request, key: Tuple, stamp: Tuple, res: Any) -> Response:
+    body = res if isinstance(res, bytes) else jotb(res)
+    etag = responses.put(key, stamp, body)
+    return etag_response(request, etag, body)
+
+def etag_response(request: Request, etag: str, body: bytes) -> Response:
+    headers = {"ETag": etag}
+    if etag_matches(etag, request.headers.get("if-none-match")):
+        return Response(status_code=304, headers=headers)
+
+    return EncodedResponse(body, headers=headers)
+
+def schema_stamp() -> Tuple:
+    schemas.refresh()
+    return (schemas.digest,)
+
+async def table_stamp(*tables: str) -> Tuple:
+    # Commits from other processes do not go through touch()
+    return responses.stamp(tables, *await db.versions(tables))
+
+# Template paths rather than raw ones, so labels stay bounded
+route_paths = dict()
+
+def route_path(scope) -> str:
+    endpoint = scope.get("endpoint")
+    if endpoint not in route_paths:
+        for route in app.routes:
+            if getattr(route, "endpoint", None) is endpoint:
+                route_paths[endpoint] = route.path
+
+    return route_paths.get(endpoint, "unmatched")
+
+"""
+Times each request until the last chunk of its body is sent, so streamed
+responses count the time spent producing them. A plain ASGI middleware, as
+an http one gets the response back as soon as its headers are ready.
+"""
+class TimeRoutes:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = perf_counter()
+        status = list()
+
+        async def timed_send(message):
+            if message["type"] == "http.response.start":
+                status.append(message["status"])
+
+            await send(message)
+            if (message["type"] == "http.response.body" and
+                not message.get("more_body", False)):
+                metrics.route(scope["method"], route_path(scope), status[0],
+                    perf_counter() - started)
+
+        await self.app(scope, receive, timed_send)
+
+app.add_middleware(TimeRoutes)
+
+@app.exception_handler(BusyError)
+async def busy_handler(request: Request, error: BusyError):
+    res = dict()
+    res["status"] = "error"
+    res["error"] = "Database is busy, try again"
+    headers = {"Retry-After": "1"}
+    return EncodedResponse(res, status_code=503, headers=headers)
+
+@app.on_event("startup")
+def startup():
+    backups.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    backups.stop()
+    await db.flush()
+    db.stop()
+
 @app.get("/api")
 async def welcome():
     return {"welcome": "Hello, world!"}
 
 @app.get("/api/")
 async def directory():
-    return {"db": "/api/db", "notes": "/api/notes"}
+    return {"db": "/api/db", "notes": "/api/notes", "backup": "/api/backup"}
 
-@app.get("/api/schema")
-async def get_all_schemas():
-    return list(models.keys())
+@app.get("/api/backup")
+async def get_backup():
+    res = dict()
+    res["status"] = "success"
+    res["data"] = backups.status()
+    return res
 
-@app.get("/api/schema/dynamic")
-async def get_dynamic_schema():
+@app.post("/api/backup")
+async def run_backup():
+    backups.run_now()
+    res = dict()
+    res["status"] = "success"
+    res["data"] = backups.status()
+    return res
+
+@app.get("/api/metrics")
+async def get_metrics():
+    return Response(content=metrics.render(),
+        media_type="text/plain; version=0.0.4")
+
+@app.get("/api/metrics/slow")
+async def get_slow_queries():
     res = dict()
     res["status"] = "success"
-    res["data"] = jsto(DynamicEntry.schema_json())
+    res["data"] = list(metrics.slow)
     return res
 
+@app.get("/api/schema")
+async def get_all_schemas(request: Request):
+    key = "schemas",
+    stamp = schema_stamp()
+    return cached(request, key, stamp) or cache(request, key, stamp,
+        list(models.keys()))
+
+def schema_response(request: Request, name: str, compiled):
+    body = b'{"status":"success","data":' + compiled.json + b'}'
+    return cache(request, ("schema", name), schema_stamp(), body)
+
+@app.get("/api/schema/dynamic")
+async def get_dynamic_schema(request: Request):
+    hit = cached(request, ("schema", "_dynamic"), schema_stamp())
+    if hit is not None:
+        return hit
+
+    return schema_response(request, "_dynamic", schemas.compile("_dynamic"))
+
 @app.get("/api/schema/{schema_name}")
-async def get_schema(schema_name: str):
+async def get_schema(request: Request, schema_name: str):
     res = dict()
+    hit = cached(request, ("schema", schema_name), schema_stamp())
+    if hit is not None:
+        return hit
 
-    model = models.get(schema_name)
-    if model is None:
+    compiled = schemas.compile(schema_name)
+    if compiled is None:
         res["status"] = "unknown"
         return res
 
-    schema_model = jsto(model.schema_json()) 
-
-    res["status"] = "success"
-    res["data"] = schema_model
-    return res
+    return schema_response(request, schema_name, compiled)
 
 @app.get("/api/db")
-async def get_all_dbs():
+async def get_all_dbs(request: Request):
+    key = "dbs",
+    stamp = await table_stamp("_catalog")
+    hit = cached(request, key, stamp)
+    if hit is not None:
+        return hit
+
     res = dict()
     res["status"] = "success"
-    res["data"] = db.get_all_tables()
-    return res
+    res["data"] = await db.get_all_tables()
+    return cache(request, key, stamp, res)
+
+def stream_export(tables: List[str], batch_size: int):
+    for batch in db.stream(SQLite.export, tables, batch_size):
+        yield jotb(batch) + b"\n"
+
+# Registered ahead of /api/db/{db_name} so it is not taken for a table name
+@app.get("/api/db/export")
+async def export_db(tables: Optional[str] = None, batch_size: int = 1000):
+    order = schemas.order()
+    if tables is not None:
+        wanted = set(tables.split(","))
+        order = [table for table in order if table in wanted]
+
+    batches = stream_export(order, batch_size)
+    return StreamingResponse(batches, media_type="application/x-ndjson")
+
+def split_param(value: Optional[str]) -> Optional[List[str]]:
+    if value is None:
+        return None
+
+    return [part.strip() for part in value.split(",") if part.strip()]
+
+"""
+e.g. parse_filter("notes", '{"eq": {"tag_id": 1}}') -> ("tag_id = ?", (1,))
+
+Filters arrive as JSON text in query parameters, or decoded in request bodies.
+"""
+def parse_filter(db_name: str, value: Any) -> Optional[Tuple[str, Tuple]]:
+    if value is None:
+        return None
+
+    if isinstance(value, str):
+        value = jsto(value)
+        if value is None:
+            raise QueryError("Invalid filter, expected JSON")
+
+    return compile_filter(schemas.types(db_name), value)
+
+def join_where(where, other):
+    if where is None or other is None:
+        return where or other
+
+    return f"({where[0]}) AND ({other[0]})", tuple(where[1]) + tuple(other[1])
+
+def stream_entries(db_name: str, fields: List[str], where, after):
+    for _, entry in db.stream(SQLite.scan, db_name, fields, where, after):
+        yield jotb(entry) + b"\n"
 
 @app.get("/api/db/{db_name}")
-async def get_db_entries(db_name: str, where_query: Optional[str] = None,
-    limit: Optional[int] = None):
+async def get_db_entries(request: Request, db_name: str,
+    where_query: Optional[str] = None, limit: Optional[int] = None,
+    cursor: Optional[str] = None, stream: bool = False,
+    filter_json: Optional[str] = Query(None, alias="filter"),
+    select: Optional[str] = None):
+    key = "entries", db_name, where_query, filter_json, select, limit, cursor
+    stamp = await table_stamp(db_name)
+    if not stream:
+        hit = cached(request, key, stamp)
+        if hit is not None:
+            return hit
+
     res = dict()
     res["status"] = "error"
-    if db_name not in db.get_all_tables():
+    if not await db.has_table(db_name):
         res["error"] = f"'{db_name}' is not a valid database, see /api/db"
         return res
 
-    model = models.get(db_name)
-    if model is None:
+    if db_name not in models:
         res["status"] = "unknown"
         return res
 
-    fields = list(model.__fields__.keys())
-    schema_model = jsto(model.schema_json())
-
     where = None
     if where_query is not None:
         where = where_query, tuple()
 
-    entries = db.lookup(db_name, fields, where=where, limit=limit)
+    try:
+        fields = project(schemas.fields(db_name), split_param(select))
+        where = join_where(where, parse_filter(db_name, filter_json))
+
+    except QueryError as e:
+        res["error"] = str(e)
+        return res
+
+    if limit is not None and limit < 0:
+        res["error"] = "Limit must not be negative"
+        return res
+
+    after = None
+    if cursor is not None:
+        position = decode_cursor(cursor)
+        if not isinstance(position, dict) or "after" not in position:
+            res["error"] = "Invalid cursor"
+            return res
+
+        after = position["after"]
+
+    if stream:
+        entries = stream_entries(db_name, fields, where, after)
+        return StreamingResponse(entries, media_type="application/x-ndjson")
+
+    entries, last = await db.page(db_name, fields, where, after, limit)
 
     res["status"] = "success"
     res["data"] = dict()
     res["data"]["entries"] = entries
-    res["data"]["schema"] = schema_model
-    return res
+    res["data"]["cursor"] = None
+    if last is not None:
+        res["data"]["cursor"] = encode_cursor({"after": last})
+
+    # Continuation pages skip the schema, the client has it from page one
+    if cursor is None:
+        res["data"]["schema"] = schemas.compile(db_name).schema
+
+    return cache(request, key, stamp, res)
 
 @app.post("/api/db/{db_name}/get")
 async def get_db(db_name: str, where_query: str,
-    where_values: Optional[DataType] = None, limit: Optional[int] = None):
+    where_values: Optional[DataType] = None, limit: Optional[int] = None,
+    select: Optional[str] = None):
     res = dict()
     res["status"] = "error"
-    if db_name not in db.get_all_tables():
+    if not await db.has_table(db_name):
         res["error"] = f"'{db_name}' is not a valid database, see /api/db"
         return res
 
-    model = models.get(db_name)
-    if model is None:
+    if db_name not in models:
         res["status"] = "unknown"
         return res
 
-    fields = list(model.__fields__.keys())
-    schema_model = jsto(model.schema_json())
+    try:
+        fields = project(schemas.fields(db_name), split_param(select))
+
+    except QueryError as e:
+        res["error"] = str(e)
+        return res
+
+    schema_model = schemas.compile(db_name).schema
 
     where = None
     if where_query is not None:
@@ -142,30 +425,121 @@ async def get_db(db_name: str, where_query: str,
         if where_values is None:
             where = where_query, tuple()
 
-    entries = db.lookup(db_name, fields, where=where, limit=limit)
+    entries = await db.lookup(db_name, fields, where=where, limit=limit)
 
     res["status"] = "success"
     res["data"] = dict()
     res["data"]["entries"] = entries
     res["data"]["schema"] = schema_model
+    return EncodedResponse(res)
+
+"""
+e.g. POST /api/db/query
+     {"table": "notes", "select": ["id", "title"], "limit": 50,
+      "filter": {"and": [{"eq": {"tag_id": 1}},
+                         {"prefix": {"title": "sql"}}]}}
+"""
+@app.post("/api/db/query")
+async def query_db(entry: GetEntry):
+    res = dict()
+    res["status"] = "error"
+    db_name = entry.table
+    if not await db.has_table(db_name):
+        res["error"] = f"'{db_name}' is not a valid database, see /api/db"
+        return res
+
+    if db_name not in models:
+        res["status"] = "unknown"
+        return res
+
+    try:
+        fields = project(schemas.fields(db_name), entry.select)
+        where = parse_filter(db_name, entry.filter)
+
+    except QueryError as e:
+        res["error"] = str(e)
+        return res
+
+    if entry.limit is not None and entry.limit < 0:
+        res["error"] = "Limit must not be negative"
+        return res
+
+    after = None
+    if entry.cursor is not None:
+        position = decode_cursor(entry.cursor)
+        if not isinstance(position, dict) or "after" not in position:
+            res["error"] = "Invalid cursor"
+            return res
+
+        after = position["after"]
+
+    entries, last = await db.page(db_name, fields, where, after, entry.limit)
+
+    res["status"] = "success"
+    res["data"] = dict()
+    res["data"]["entries"] = entries
+    res["data"]["cursor"] = None
+    if last is not None:
+        res["data"]["cursor"] = encode_cursor({"after": last})
+
+    if entry.cursor is None:
+        res["data"]["schema"] = schemas.compile(db_name).schema
+
+    return EncodedResponse(res)
+
+@app.post("/api/db/{db_name}/explain")
+async def explain_db(db_name: str, where_query: Optional[str] = None,
+    where_values: Optional[DataType] = None,
+    filter_json: Optional[str] = Query(None, alias="filter"),
+    select: Optional[str] = None):
+    res = dict()
+    res["status"] = "error"
+    if not await db.has_table(db_name):
+        res["error"] = f"'{db_name}' is not a valid database, see /api/db"
+        return res
+
+    if db_name not in models:
+        res["status"] = "unknown"
+        return res
+
+    where = None
+    if where_query is not None:
+        where = where_query, where_values
+        if where_values is None:
+            where = where_query, tuple()
+
+    try:
+        fields = project(schemas.fields(db_name), split_param(select))
+        where = join_where(where, parse_filter(db_name, filter_json))
+
+    except QueryError as e:
+        res["error"] = str(e)
+        return res
+
+    plan = await db.explain(db_name, fields, where)
+    if plan is None:
+        res["error"] = "Could not explain query"
+        return res
+
+    res["status"] = "success"
+    res["data"] = plan
     return res
 
-def is_valid(db_name: str, data: KeyedDict) -> int:
+async def is_valid(db_name: str, data: KeyedDict) -> int:
     res = dict()
     res["status"] = "error"
-    if db_name not in db.get_all_tables():
+    if not await db.has_table(db_name):
         res["data"] = f"'{db_name}' is not a valid database, see /api/db"
         return 1, res
 
-    model = models.get(db_name)
-    if model is None:
+    if db_name not in models:
         res["status"] = "unknown"
         res["data"] = None
         return 2, res
 
-    schema_model = jsto(model.schema_json())
+    compiled = schemas.compile(db_name)
     try:
-        validate(instance=data, schema=schema_model)
+        compiled.validator.validate(data)
         return 0, res
 
     except ValidationError as e:
@@ -174,74 +548,335 @@ def is_valid(db_name: str, data: KeyedDict) -> int:
 
 @app.post("/api/db/{db_name}/put")
 async def put_db(db_name: str, data: KeyedDict):
-    valid_state, res = is_valid(db_name, data)
+    valid_state, res = await is_valid(db_name, data)
     if valid_state != 0:
         return res
 
-    with db.transaction():
+    res["status"] = "success"
+    res["data"] = await db.insert(db_name, data)
+    touch(db_name)
+
+    return res
+
+"""
+e.g. conflict_keys("tags", {"tag": "sql"}, None) -> ["tag"]
+
+The unique key named by `on`, else the first one `row` gives every field of.
+"""
+def conflict_keys(db_name: str, row: KeyedDict,
+    on: Optional[str]) -> Optional[List[str]]:
+    keys = schemas.unique_keys(db_name)
+    if on is not None:
+        wanted = split_param(on)
+        return wanted if wanted in keys else None
+
+    for key in keys:
+        if all(field in row for field in key):
+            return key
+
+    return None
+
+def keys_error(db_name: str) -> str:
+    keys = " or ".join(",".join(key) for key in schemas.unique_keys(db_name))
+    return f"Expected a unique key of '{db_name}': {keys or 'none declared'}"
+
+"""
+e.g. POST /api/db/tags/upsert {"tag": "sql"} -> {"data": {"id": 1}}
+
+Inserts the row, or updates the one it conflicts with on `on`, a unique key
+picked from the row by default. With `ensure` an existing row is left as it
+is and only its id returned.
+"""
+@app.post("/api/db/{db_name}/upsert")
+async def upsert_db(db_name: str, data: KeyedDict, on: Optional[str] = None,
+    ensure: bool = False):
+    valid_state, res = await is_valid(db_name, data)
+    if valid_state != 0:
+        return res
+
+    keys = conflict_keys(db_name, data, on)
+    if keys is None:
+        res["error"] = keys_error(db_name)
+        return res
+
+    update = list() if ensure else None
+    row_id = await db.upsert(db_name, data, keys, update)
+    touch(db_name)
+    if row_id is None:
+        res["error"] = "Could not upsert row"
+        return res
+
+    res["status"] = "success"
+    res["data"] = dict()
+    res["data"]["id"] = row_id
+    return res
+
+"""
+e.g. POST /api/db/tags/ensure [{"tag": "sql"}, {"tag": "new"}]
+     -> {"data": {"ids": [1, 2]}}
+
+Ids for a whole list of rows, in order, inserting the missing ones.
+"""
+# Runs on the writer, so the error it reads is the one this call left
+def ensure_rows(sqlite: SQLite, db_name: str, rows: List[KeyedDict],
+    keys: List[str]):
+    sqlite.last_error = None
+    return sqlite.ensure_many(db_name, rows, keys), sqlite.last_error
+
+@app.post("/api/db/{db_name}/ensure")
+async def ensure_db(db_name: str, rows: List[KeyedDict],
+    on: Optional[str] = None):
+    res = dict()
+    res["status"] = "error"
+    if not await db.has_table(db_name):
+        res["error"] = f"'{db_name}' is not a valid database, see /api/db"
+        return res
+
+    if db_name not in models:
+        res["status"] = "unknown"
+        return res
+
+    if len(rows) == 0:
         res["status"] = "success"
-        res["data"] = db.insert(db_name, data)
+        res["data"] = dict()
+        res["data"]["ids"] = list()
+        return res
+
+    # One statement per chunk needs one column list for every row
+    columns = list(rows[0])
+    for index, row in enumerate(rows):
+        if set(row) != set(columns):
+            res["error"] = f"Row {index} has other fields than row 0, every "
+            res["error"] = f"{res['error']}row needs {', '.join(columns)}"
+            return res
+
+    compiled = schemas.compile(db_name)
+    for index, row in enumerate(rows):
+        try:
+            compiled.validator.validate(row)
+
+        except ValidationError as e:
+            res["error"] = f"Row {index}: {e.message}"
+            return res
+
+    keys = conflict_keys(db_name, rows[0], on)
+    if keys is None:
+        res["error"] = keys_error(db_name)
+        return res
+
+    rows = [{column: row[column] for column in columns} for row in rows]
+    ids, error = await db.write(ensure_rows, db_name, rows, keys)
+    touch(db_name)
+    if ids is None:
+        res["error"] = f"Could not ensure rows: {error}"
+        return res
+
+    res["status"] = "success"
+    res["data"] = dict()
+    res["data"]["ids"] = ids
+    return res
+
+async def read_rows(request: Request):
+    content_type = request.headers.get("content-type", "")
+    if "ndjson" not in content_type:
+        rows = await request.json()
+        if not isinstance(rows, list):
+            rows = [rows]
+
+        for row in rows:
+            yield row
+
+        return
+
+    buffer = b""
+    async for chunk in request.stream():
+        buffer = buffer + chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield jsto(line)
+
+    if buffer.strip():
+        yield jsto(buffer)
+
+async def put_batch(db_name: str, validator, batch: List[Any]):
+    results = [None] * len(batch)
+    valid = list()
+    positions = list()
+    for index, row in enumerate(batch):
+        try:
+            validator.validate(row)
+            valid.append(row)
+            positions.append(index)
+
+        except ValidationError as e:
+            results[index] = {"error": e.message}
+
+    if len(valid) > 0:
+        inserted = await db.insert_many(db_name, valid)
+        touch(db_name)
+        for index, result in zip(positions, inserted):
+            results[index] = result
+
+    return results
+
+@app.post("/api/db/{db_name}/put_many")
+async def put_many_db(db_name: str, request: Request, batch_size: int = 500):
+    res = dict()
+    res["status"] = "error"
+    if not await db.has_table(db_name):
+        res["data"] = f"'{db_name}' is not a valid database, see /api/db"
+        return res
+
+    compiled = schemas.compile(db_name)
+    if compiled is None:
+        res["status"] = "unknown"
+        res["data"] = None
+        return res
+
+    results = list()
+    batch = list()
+    async for row in read_rows(request):
+        batch.append(row)
+        if len(batch) >= batch_size:
+            results.extend(await put_batch(db_name, compiled.validator, batch))
+            batch = list()
+
+    if len(batch) > 0:
+        results.extend(await put_batch(db_name, compiled.validator, batch))
 
+    res["status"] = "success"
+    res["data"] = results
     return res
 
 @app.put("/api/db/{db_name}/fix")
 async def fix_db(db_name: str, data: KeyedDict, where_query: str,
     where_values: Optional[DataType] = None):
-    valid_state, res = is_valid(db_name, data)
+    valid_state, res = await is_valid(db_name, data)
     if valid_state != 0:
         return res
 
     if where_values is None:
         where_values = tuple()
 
-    with db.transaction():
-        res["status"] = "success"
-        res["data"] = db.update(db_name, data, (where_query, where_values))
+    res["status"] = "success"
+    res["data"] = await db.update(db_name, data, (where_query, where_values))
+    touch(db_name)
 
     return res
 
 @app.delete("/api/db/{db_name}/pop")
 async def pop_db(db_name: str, entry_id: int):
     res = dict()
-    with db.transaction():
-        res["success"] = "success"
-        res["data"] = db.delete(db_name, ("id = ?", (entry_id,)))
+    if not await db.has_table(db_name):
+        res["status"] = "error"
+        res["error"] = f"'{db_name}' is not a valid database, see /api/db"
+        return res
+
+    res["success"] = "success"
+    res["data"] = await db.delete(db_name, ("id = ?", (entry_id,)))
+    touch(db_name)
 
     return res
 
 @app.post("/api/db/put")
-async def put_any_db(entry: DynamicEntry):
+async def put_any_db(entry: Dict[str, Optional[KeyedDict]]):
     db_res = dict()
-    fields = entry.__fields__
-    for name in fields.keys():
-        entry_fields = getattr(entry, name, None)
+    for name, entry_fields in entry.items():
         if entry_fields is None:
             continue
 
-        meta_fields = getattr(entry_fields, "__fields__", None)
-        if meta_fields is None:
+        if name not in models:
+            db_res[name] = None
+            continue
+
+        # The model parses values, e.g. ISO timestamps, and drops unknown keys
+        try:
+            row = models[name](**entry_fields)
+
+        except ModelError as e:
+            db_res[name] = str(e)
             continue
 
         db_fields = dict()
-        for field_name in meta_fields.keys():
-            field_data = getattr(entry_fields, field_name, None)
+        for field_name in row.__fields__.keys():
+            field_data = getattr(row, field_name, None)
             if field_data is not None:
                 db_fields[field_name] = field_data
 
-        with db.transaction():        
-            db_res[name] = db.insert(name, db_fields)
+        db_res[name] = await db.insert(name, db_fields)
+        touch(name)
 
     res = dict()
     res["status"] = "unknown"
     res["data"] = db_res
     return res
 
+"""
+e.g. POST /api/db/graph
+     {"notes": [{"$id": "note", "title": "abc", ...}],
+      "data": [{"$id": "data", "raw_data": "xyz"}],
+      "tags": [{"$id": "sql", "tag": "sql"}],
+      "tagmap": [{"id": 1, "note_id": {"$ref": "note"},
+                  "tag_id": {"$ref": "sql"}, "data_id": {"$ref": "data"}}]}
+     -> {"status": "success", "data": {"ids": {"notes": [1], ...},
+         "refs": {"data": 1, "note": 1, "sql": 1}}}
+
+Every row is inserted in one transaction, or none are.
+"""
+@app.post("/api/db/graph")
+async def put_graph_db(graph: Dict[str, List[KeyedDict]]):
+    res = dict()
+    res["status"] = "error"
+    try:
+        plan = plan_graph(schemas, graph)
+
+    except GraphError as e:
+        res["error"] = str(e)
+        return res
+
+    for table, index, _, _, row in plan:
+        compiled = schemas.compile(table)
+        if compiled is None:
+            res["error"] = f"'{table}' has no schema"
+            return res
+
+        try:
+            compiled.validator.validate(stub_refs(row))
+
+        except ValidationError as e:
+            res["error"] = f"{table}[{index}]: {e.message}"
+            return res
+
+    try:
+        async with db.session() as run:
+            ids, refs = await run(insert_graph, plan)
+
+    except GraphError as e:
+        res["error"] = str(e)
+        return res
+
+    for table in ids:
+        touch(table)
+
+    res["status"] = "success"
+    res["data"] = dict()
+    res["data"]["ids"] = ids
+    res["data"]["refs"] = refs
+    return res
+
 @app.delete("/api/db/drop")
 async def drop_db(entry: Entry):
     res = dict()
-    with db.transaction():
-        res["success"] = "success"
-        res["data"] = db.drop_table(entry.table)
+    if not await db.has_table(entry.table):
+        res["status"] = "error"
+        res["error"] = f"'{entry.table}' is not a valid database, see /api/db"
+        return res
+
+    res["success"] = "success"
+    res["data"] = await db.drop_table(entry.table)
+    touch(entry.table)
+    touch("_catalog")
 
     return res
 
@@ -251,3 +886,255 @@ async def get_notes():
     #with db.transaction():
 
     return messages
+
+def narrow_fields(db_name: str) -> List[str]:
+    raw_schema = schemas.raw.get(db_name, dict())
+    return [field for field in schemas.fields(db_name)
+        if raw_schema.get(field, dict()).get("type") != "text"]
+
+def fts_query(query: str) -> str:
+    terms = query.split()
+    return " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+
+async def search_table(db_name: str, q: str, limit: int, offset: int,
+    raw: bool):
+    res = dict()
+    res["status"] = "error"
+    fts = schemas.fts.get(db_name)
+    if fts is None:
+        res["error"] = f"'{db_name}' does not support full-text search"
+        return res
+
+    if db_name not in models:
+        res["status"] = "unknown"
+        return res
+
+    # Wide text columns are left out, the snippet stands in for them
+    fields = narrow_fields(db_name)
+    query = q if raw else fts_query(q)
+    entries = await db.search(db_name, fts["table"], fields, query, limit,
+        offset)
+    if entries is None:
+        res["error"] = "Invalid search query"
+        return res
+
+    res["status"] = "success"
+    res["data"] = dict()
+    res["data"]["entries"] = entries
+    res["data"]["offset"] = offset + len(entries)
+    return EncodedResponse(res)
+
+@app.get("/api/db/{db_name}/aggregate")
+async def aggregate_db(request: Request, db_name: str,
+    group_by: Optional[str] = None,
+    metric_list: Optional[str] = Query(None, alias="metrics"),
+    bucket: Optional[str] = None, order: Optional[str] = None,
+    limit: Optional[int] = None,
+    filter_json: Optional[str] = Query(None, alias="filter")):
+    key = ("aggregate", db_name, group_by, metric_list, bucket, order, limit,
+        filter_json)
+    stamp = await table_stamp(db_name)
+    hit = cached(request, key, stamp)
+    if hit is not None:
+        return hit
+
+    res = dict()
+    res["status"] = "error"
+    if not await db.has_table(db_name):
+        res["error"] = f"'{db_name}' is not a valid database, see /api/db"
+        return res
+
+    if db_name not in models:
+        res["status"] = "unknown"
+        return res
+
+    # e.g. bucket=created_at:month
+    bucket_by = None
+    if bucket is not None:
+        field, _, unit = bucket.partition(":")
+        bucket_by = field, unit or "day"
+
+    try:
+        executor, values, terms = compile_aggregate(db_name,
+            schemas.types(db_name), split_param(group_by),
+            split_param(metric_list), bucket_by, order, limit,
+            parse_filter(db_name, filter_json))
+
+    except QueryError as e:
+        res["error"] = str(e)
+        return res
+
+    results = await db.read(SQLite.fetch, executor, values)
+    if results is False:
+        res["error"] = "Could not run aggregate query"
+        return res
+
+    res["status"] = "success"
+    res["data"] = [dict(zip(terms, result)) for result in results]
+    return cache(request, key, stamp, res)
+
+@app.get("/api/db/{db_name}/search")
+async def search_db(db_name: str, q: str, limit: int = 20, offset: int = 0,
+    raw: bool = False):
+    return await search_table(db_name, q, limit, offset, raw)
+
+@app.get("/api/notes/search")
+async def search_notes(q: str, limit: int = 20, offset: int = 0,
+    raw: bool = False):
+    return await search_table("notes", q, limit, offset, raw)
+
+@app.get("/api/tags/query")
+async def query_tags(q: str, after: Optional[int] = None, limit: int = 50):
+    # Each page is looked up with one `id IN (...)`, capped like `in` filters
+    if limit < 1 or limit > MAX_IN:
+        limit = MAX_IN
+
+    res = dict()
+    res["status"] = "error"
+    try:
+        note_ids = await tag_index.query(q, after, limit)
+
+    except TagSyntaxError as e:
+        res["error"] = str(e)
+        return res
+
+    if note_ids is None:
+        res["error"] = "Could not run tag query"
+        return res
+
+    entries = list()
+    if len(note_ids) > 0:
+        fields = narrow_fields("notes")
+        places = ",".join(["?"] * len(note_ids))
+        where = f"id IN ({places})", tuple(note_ids)
+        entries = await db.lookup("notes", fields, where=where)
+        entries.sort(key=lambda entry: entry["id"])
+
+    res["status"] = "success"
+    res["data"] = dict()
+    res["data"]["entries"] = entries
+    res["data"]["after"] = note_ids[-1] if len(note_ids) == limit else None
+    return EncodedResponse(res)
+
+def nest_tree(nodes: List[KeyedDict], parent: str) -> List[KeyedDict]:
+    by_id = {node["id"]: node for node in nodes}
+    roots = list()
+    for node in nodes:
+        node["children"] = list()
+
+    for node in nodes:
+        parent_node = by_id.get(node.get(parent))
+        if parent_node is None or parent_node is node:
+            roots.append(node)
+
+        else:
+            parent_node["children"].append(node)
+
+    return roots
+
+def stream_tree(db_name: str, root: int, fields: List[str], parent: str,
+    direction: str, depth: Optional[int]):
+    nodes = db.stream(SQLite.iter_tree, db_name, root, fields, parent,
+        direction, depth)
+    for node in nodes:
+        yield jotb(node) + b"\n"
+
+@app.get("/api/db/{db_name}/tree/{entry_id}")
+async def get_db_tree(db_name: str, entry_id: int,
+    direction: str = "descendants", depth: Optional[int] = None,
+    format: str = "flat"):
+    res = dict()
+    res["status"] = "error"
+    parent = schemas.self_reference(db_name)
+    if parent is None:
+        res["error"] = f"'{db_name}' is not a tree, it has no self reference"
+        return res
+
+    if direction not in ("descendants", "ancestors"):
+        res["error"] = "direction must be 'descendants' or 'ancestors'"
+        return res
+
+    if db_name not in models:
+        res["status"] = "unknown"
+        return res
+
+    fields = schemas.fields(db_name)
+    if format == "stream":
+        nodes = stream_tree(db_name, entry_id, fields, parent, direction,
+            depth)
+        return StreamingResponse(nodes, media_type="application/x-ndjson")
+
+    nodes = await db.tree(db_name, entry_id, fields, parent, direction, depth)
+
+    res["status"] = "success"
+    res["data"] = nest_tree(nodes, parent) if format == "nested" else nodes
+    return EncodedResponse(res)
+
+@app.post("/api/db/import")
+async def import_db(request: Request, mode: str = "append",
+    chunk_size: int = 1000):
+    res = dict()
+    res["status"] = "error"
+    if mode not in ("append", "replace"):
+        res["error"] = "mode must be 'append' or 'replace'"
+        return res
+
+    order = schemas.order()
+    counts = dict()
+    try:
+        async with db.session(defer_foreign_keys=True) as run:
+            if mode == "replace":
+                for table in reversed(order):
+                    if table in db.writer.tables:
+                        await run(SQLite.execute, f"DELETE FROM {table}")
+
+            table = None
+            columns = None
+            rows = list()
+
+            async def flush():
+                if len(rows) > 0:
+                    imported = await run(SQLite.import_rows, table, columns,
+                        rows)
+                    counts[table] = counts.get(table, 0) + imported
+                    rows.clear()
+
+            async for line in read_rows(request):
+                if not isinstance(line, dict):
+                    raise ValueError(f"Unexpected line: {line}")
+
+                if line.get("table") not in order:
+                    raise ValueError(f"Unknown table: {line.get('table')}")
+
+                if "columns" in line:
+                    await flush()
+                    table = line["table"]
+                    columns = line["columns"]
+                    known = db.writer.columns.get(table, dict())
+                    unknown = [column for column in columns
+                        if column not in known]
+                    if len(columns) == 0 or len(unknown) > 0:
+                        raise ValueError(f"Unknown columns in {table}: "
+                            f"{unknown or columns}")
+
+                if "rows" in line:
+                    if line["table"] != table:
+                        raise ValueError(f"Rows for {line['table']} came "
+                            "before its columns")
+
+                    rows.extend(line["rows"])
+                    if len(rows) >= chunk_size:
+                        await flush()
+
+            await flush()
+
+    except (ValueError, SQLiteError) as e:
+        res["error"] = str(e)
+        return res
+
+    for table in order:
+        touch(table)
+
+    res["status"] = "success"
+    res["data"] = counts
+    return res
@@ -0,0 +1,106 @@
+from helpers.encode import jots, jsto, JSON_BACKEND
+from helpers.datetime import now
+from helpers.general import eprint
+from database.schemas import Schemas
+from benchmarks.datasets import SIZES, build, counts
+from benchmarks.timing import compare
+
+import sys
+from sqlite3 import sqlite_version
+from pathlib import Path
+from platform import python_version
+from argparse import ArgumentParser
+
+"""
+e.g.
+    python -m benchmarks --size 10k --output results.json
+    python -m benchmarks --size 1m --baseline benchmarks/baseline.json
+    python -m benchmarks --size 10k --save-baseline
+
+Results are JSON with a `meta` block describing the run, the `results` of
+every benchmark and, when a baseline exists, a `comparison` of medians. Any
+regression beyond the threshold exits with status 1.
+"""
+BASELINE = Path(__file__).parent.absolute() / "baseline.json"
+
+def parse_args(argv):
+    parser = ArgumentParser(prog="python -m benchmarks")
+    parser.add_argument("--size", choices=list(SIZES), default="10k")
+    parser.add_argument("--suite", nargs="+", choices=["sqlite", "api"],
+        default=["sqlite", "api"])
+    parser.add_argument("--ops", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output")
+    parser.add_argument("--baseline", default=str(BASELINE))
+    parser.add_argument("--threshold", type=float, default=0.1)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--rebuild", action="store_true")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    schemas = Schemas()
+    db_file = build(schemas, args.size, args.seed, rebuild=args.rebuild)
+
+    results = dict()
+    if "sqlite" in args.suite:
+        from benchmarks import sqlite_bench
+        results.update(sqlite_bench.run(schemas, db_file, args.size,
+            args.ops, args.seed))
+
+    # Requests are heavier than wrapper calls, so fewer of them
+    if "api" in args.suite:
+        from benchmarks import api_bench
+        results.update(api_bench.run(schemas, db_file, args.size,
+            max(args.ops // 5, 1), args.seed))
+
+    report = dict()
+    report["meta"] = dict()
+    report["meta"]["size"] = args.size
+    report["meta"]["rows"] = counts(schemas, SIZES[args.size])
+    report["meta"]["ops"] = args.ops
+    report["meta"]["seed"] = args.seed
+    report["meta"]["started"] = now().isoformat()
+    report["meta"]["python"] = python_version()
+    report["meta"]["sqlite"] = sqlite_version
+    report["meta"]["json"] = JSON_BACKEND
+    report["results"] = results
+
+    baseline_file = Path(args.baseline)
+    regressions = list()
+    if baseline_file.is_file() and not args.save_baseline:
+        baseline = jsto(baseline_file.read_text()) or dict()
+        if baseline.get("meta", dict()).get("size") != args.size:
+            eprint("Baseline is for another size, not comparing")
+
+        else:
+            report["comparison"] = compare(results, baseline["results"],
+                args.threshold)
+            regressions = [name for name, entry in
+                report["comparison"].items() if entry["regression"]]
+
+    print_table(report)
+    output = jots(report, readable=True)
+    if args.output is not None:
+        Path(args.output).write_text(output)
+
+    if args.save_baseline:
+        baseline_file.write_text(output)
+
+    for name in regressions:
+        eprint(f"Regression: {name}")
+
+    return 1 if len(regressions) > 0 else 0
+
+def print_table(report):
+    comparison = report.get("comparison", dict())
+    print(f"{'benchmark':<24}{'ops/s':>12}{'p50 ms':>10}{'p99 ms':>10}"
+        f"{'change':>10}")
+    for name, stats in report["results"].items():
+        change = comparison.get(name, dict()).get("change")
+        change = "" if change is None else f"{change:+.1%}"
+        print(f"{name:<24}{stats['ops_per_sec']:>12.1f}"
+            f"{stats['p50_ms']:>10.3f}{stats['p99_ms']:>10.3f}{change:>10}")
+
+if __name__ == "__main__":
+    sys.exit(main())
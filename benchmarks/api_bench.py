@@ -0,0 +1,111 @@
+from helpers.general import eprint
+from benchmarks.datasets import SIZES, WORDS, counts, rows
+from benchmarks.timing import measure, measure_each
+
+from os import environ
+from random import Random
+
+"""
+e.g. run(schemas, "benchmarks/.data/10k-0-3f2a9c1b.db", "10k", ops=200)
+     -> {"api.entries": {...}, "api.search": {...}, ...}
+
+Drives the app in-process through Starlette's TestClient, so the numbers
+cover routing, validation and serialization but not the network. The app
+binds its database at import, so this has to run before anything else
+imports `api`.
+"""
+def run(schemas, db_file, size, ops=200, seed=0):
+    environ["EPICURE_DB"] = db_file
+    try:
+        from fastapi.testclient import TestClient
+
+    except ImportError as e:
+        eprint(f"Skipping API benchmarks: {e}")
+        return dict()
+
+    import api
+
+    rng = Random(seed)
+    sizes = counts(schemas, SIZES[size])
+    total = sizes["notes"]
+    results = dict()
+    with TestClient(api.app) as client:
+        call = lambda method, url, **kwargs: _check(client.request(method,
+            url, **kwargs))
+
+        cursors = [None]
+        def entries():
+            params = {"limit": 100}
+            if cursors[-1] is not None:
+                params["cursor"] = cursors[-1]
+
+            body = call("GET", "/api/db/notes", params=params).json()
+            cursors.append(body["data"]["cursor"])
+
+        results["api.entries"] = measure(entries, ops, warmup=0)
+
+        cached = lambda: call("GET", "/api/db/notes", params={"limit": 100})
+        results["api.entries_cached"] = measure(cached, ops)
+
+        _check_isolation(client, call)
+
+        get = lambda: call("POST", "/api/db/notes/get",
+            params={"where_query": "id = ?"}, json=[rng.randint(1, total)])
+        results["api.get"] = measure(get, ops)
+
+        search = lambda: call("GET", "/api/notes/search",
+            params={"q": rng.choice(WORDS)})
+        results["api.search"] = measure(search, ops)
+
+        tags = lambda: call("GET", "/api/tags/query", params={"q":
+            f"tags-tag-{rng.randrange(sizes['tags'])} OR "
+            f"tags-tag-{rng.randrange(sizes['tags'])}"})
+        results["api.tags"] = measure(tags, ops)
+
+        for table in schemas.order():
+            if schemas.self_reference(table) is None:
+                continue
+
+            tree = lambda: call("GET", f"/api/db/{table}/tree/"
+                f"{rng.randint(1, sizes[table])}", params={"depth": 3})
+            results[f"api.tree.{table}"] = measure(tree, ops)
+
+        fresh = rows(schemas, "notes", sizes, rng, total, total + ops)
+        put = lambda row: _written(call("POST", "/api/db/notes/put",
+            json=row))
+        results["api.put"] = measure_each(put, [(row,) for row in fresh])
+
+        ids = api.db.writer.fetch("SELECT id FROM notes WHERE id > ?",
+            (total,))
+        pop = lambda row_id: _written(call("DELETE", "/api/db/notes/pop",
+            params={"entry_id": row_id}))
+        results["api.pop"] = measure_each(pop, ids)
+
+    return results
+
+# A write to one table has to leave cached responses of others valid
+def _check_isolation(client, call):
+    params = {"limit": 100}
+    etag = call("GET", "/api/db/notes", params=params).headers["etag"]
+    added = call("POST", "/api/db/tags/upsert",
+        json={"tag": "bench-isolation"})
+    tag_id = added.json()["data"]["id"]
+    cached = client.get("/api/db/notes", params=params,
+        headers={"If-None-Match": etag})
+    _written(call("DELETE", "/api/db/tags/pop",
+        params={"entry_id": tag_id}))
+    if cached.status_code != 304:
+        raise RuntimeError("A write to tags invalidated cached notes pages")
+
+def _check(response):
+    if response.status_code >= 400:
+        raise RuntimeError(f"{response.status_code}: {response.text}")
+
+    return response
+
+# Failed writes still answer 200, with False as their data
+def _written(response):
+    if response.json().get("data") is not True:
+        raise RuntimeError(f"Write failed: {response.text}")
+
+    return response
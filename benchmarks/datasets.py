@@ -0,0 +1,177 @@
+from database.sqlite import SQLite, plain
+
+from os import replace, remove
+from os.path import isfile
+from pathlib import Path
+from random import Random
+from datetime import datetime, timedelta
+
+SIZES = dict()
+SIZES["10k"] = 10_000
+SIZES["1m"] = 1_000_000
+SIZES["10m"] = 10_000_000
+
+# Share of the dataset size each table gets, tables not listed get all of it
+SHARES = dict()
+SHARES["tags"] = 0.01
+
+WORDS = ("sqlite", "python", "index", "query", "cache", "write", "read",
+    "note", "tag", "tree", "page", "batch", "search", "schema", "table",
+    "commit", "lock", "journal", "vacuum", "cursor", "token", "stream")
+
+START = datetime(2020, 1, 1)
+DATA_PATH = Path(__file__).parent.absolute() / ".data"
+
+"""
+e.g. counts(schemas, 10_000) -> {"data": 10000, "notes": 10000, ...}
+"""
+def counts(schemas, size):
+    sizes = dict()
+    for table in schemas.order():
+        sizes[table] = max(int(size * SHARES.get(table, 1)), 10)
+
+    return sizes
+
+def _fields(spec):
+    return {key: value for key, value in spec.items()
+        if not key.startswith("_") and isinstance(value, dict)
+        and "type" in value}
+
+def _references(table, spec):
+    references = dict()
+    for key, value in _fields(spec).items():
+        reference = value.get("references")
+        if isinstance(reference, dict):
+            references[key] = reference.get("table", table)
+
+    foreign_keys = spec.get("_sql", dict()).get("foreign_key", dict())
+    for key, value in foreign_keys.items():
+        reference = value.get("references", dict())
+        references[key] = reference.get("table", table)
+
+    return references
+
+"""
+Rows for `table` built from its schema file, so new fields and tables are
+picked up without touching the benchmarks. Text is unique per row and
+drawn from a small vocabulary so full-text search has something to match,
+foreign keys point at rows of the referenced table and self references
+build a forest.
+
+e.g. next(rows(schemas, "tags", sizes, Random(0))) -> {"tag": "tags-tag-0"}
+
+Rows from `start` on continue past the dataset, e.g. fresh rows to insert.
+"""
+def rows(schemas, table, sizes, rng, start=0, stop=None):
+    spec = schemas.raw[table]
+    fields = _fields(spec)
+    references = _references(table, spec)
+    primary_key = spec.get("_sql", dict()).get("primary_key", list())
+
+    # Composite keys of references count through every pair exactly once
+    radix = list()
+    for key in primary_key:
+        if key in references:
+            radix.append((key, sizes[references[key]]))
+
+    for index in range(start, sizes[table] if stop is None else stop):
+        row = dict()
+        place = index
+        for key, base in radix:
+            row[key] = place % base + 1
+            place = place // base
+
+        for key, value in fields.items():
+            if key in row:
+                continue
+
+            if key in references:
+                row[key] = _reference(table, references[key], index, sizes,
+                    rng)
+                continue
+
+            # Primary keys are left for SQLite to assign
+            field = _value(f"{table}-{key}", value, index, rng)
+            if field is not None:
+                row[key] = field
+
+        yield row
+
+def _reference(table, referenced, index, sizes, rng):
+    if referenced != table:
+        return rng.randint(1, sizes[referenced])
+
+    # Roots stay common enough that trees remain shallow and wide
+    if index == 0 or rng.random() < 0.1:
+        return None
+
+    return rng.randint(1, index)
+
+def _value(prefix, spec, index, rng):
+    kind = spec["type"]
+    if kind in ("integer", "int"):
+        return None if spec.get("primary_key", False) else index + 1
+
+    if kind == "varchar":
+        value = f"{prefix}-{index}"
+        return value[-spec.get("max_length", len(value)):]
+
+    if kind == "text":
+        words = " ".join(rng.choices(WORDS, k=12))
+        return f"{words} {prefix}-{index}"
+
+    if kind == "timestamp":
+        return plain(START + timedelta(seconds=index))
+
+    if kind == "boolean":
+        return rng.random() < 0.5
+
+    return None
+
+"""
+e.g. build(schemas, "10k") -> ".../benchmarks/.data/10k-0-3f2a9c1b.db"
+
+Datasets are cached by size, seed and schema digest, and built in a scratch
+file that is only moved into place once complete.
+"""
+def build(schemas, size, seed=0, chunk_size=10_000, rebuild=False):
+    DATA_PATH.mkdir(exist_ok=True)
+    db_file = DATA_PATH / f"{size}-{seed}-{schemas.digest[:8]}.db"
+    if isfile(db_file) and not rebuild:
+        return str(db_file)
+
+    scratch = f"{db_file}.build"
+    for suffix in ("", "-wal", "-shm"):
+        if isfile(f"{scratch}{suffix}"):
+            remove(f"{scratch}{suffix}")
+
+    db = SQLite(scratch)
+    # A half-built scratch file is thrown away, so durability is not needed
+    db.connection.execute("PRAGMA synchronous = OFF")
+    schemas.create_tables(db)
+
+    rng = Random(seed)
+    sizes = counts(schemas, SIZES[size])
+    for table in schemas.order():
+        chunk = list()
+        for row in rows(schemas, table, sizes, rng):
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                _insert(db, table, chunk)
+                chunk = list()
+
+        if len(chunk) > 0:
+            _insert(db, table, chunk)
+
+    db.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    db.stop()
+    replace(scratch, db_file)
+    return str(db_file)
+
+def _insert(db, table, chunk):
+    with db.transaction():
+        results = db.insert_many(table, chunk)
+
+    failed = [result for result in results if "error" in result]
+    if len(failed) > 0:
+        raise RuntimeError(f"{table}: {failed[0]['error']}")
@@ -0,0 +1,63 @@
+from database.sqlite import SQLite
+from benchmarks.datasets import SIZES, counts, rows
+from benchmarks.timing import measure, measure_each
+
+from random import Random
+
+"""
+e.g. run(schemas, "benchmarks/.data/10k-0-3f2a9c1b.db", "10k", ops=1000)
+     -> {"sqlite.insert": {...}, "sqlite.lookup": {...}, ...}
+
+Times the wrapper directly on `notes`, each write in its own committed
+transaction as the API issues them. The rows it inserts are deleted again,
+so the dataset is unchanged for the next run.
+"""
+def run(schemas, db_file, size, ops=1000, seed=0):
+    rng = Random(seed)
+    sizes = counts(schemas, SIZES[size])
+    total = sizes["notes"]
+    fields = schemas.fields("notes")
+
+    # Errors are raised rather than returned as False, so none go uncounted
+    db = SQLite(db_file, strict=True)
+    results = dict()
+
+    fresh = list(rows(schemas, "notes", sizes, rng, total, total + ops))
+    insert = lambda row: db.insert("notes", row, commit=True)
+    results["sqlite.insert"] = measure_each(insert, [(row,) for row in fresh])
+
+    ids = [row[0] for row in db.fetch("SELECT id FROM notes WHERE id > ?",
+        (total,))]
+
+    point = lambda: db.lookup("notes", fields,
+        ("id = ?", (rng.randint(1, total),)))
+    results["sqlite.lookup"] = measure(point, ops)
+
+    page = lambda: db.lookup("notes", fields, limit=100)
+    results["sqlite.lookup_page"] = measure(page, ops)
+
+    indexed = lambda: db.lookup("notes", fields,
+        ("last_updated_at > ?", (fresh[rng.randrange(ops)]["created_at"],)),
+        limit=100)
+    results["sqlite.lookup_index"] = measure(indexed, ops)
+
+    update = lambda row_id: db.update("notes", {"contents": "updated"},
+        ("id = ?", (row_id,)), commit=True)
+    results["sqlite.update"] = measure_each(update, [(i,) for i in ids])
+
+    delete = lambda row_id: db.delete("notes", ("id = ?", (row_id,)),
+        commit=True)
+    results["sqlite.delete"] = measure_each(delete, [(i,) for i in ids])
+
+    batches = [fresh[start:start + 100] for start in range(0, ops, 100)]
+    insert_many = lambda batch: _insert_many(db, batch)
+    results["sqlite.insert_many"] = measure_each(insert_many,
+        [(batch,) for batch in batches])
+
+    db.delete("notes", ("id > ?", (total,)), commit=True)
+    db.stop()
+    return results
+
+def _insert_many(db, batch):
+    with db.transaction():
+        db.insert_many("notes", batch)
@@ -0,0 +1,88 @@
+from time import perf_counter_ns
+from statistics import mean
+
+"""
+e.g. measure(lambda: db.lookup_one("tags", ["id"]), 1000)
+     -> {"ops": 1000, "seconds": 0.04, "ops_per_sec": 25000.0, ...}
+
+Each call is timed on its own so the percentiles show the tail as well as
+the average.
+"""
+def measure(func, ops, warmup=10):
+    for _ in range(min(warmup, ops)):
+        func()
+
+    samples = list()
+    for _ in range(ops):
+        started = perf_counter_ns()
+        func()
+        samples.append(perf_counter_ns() - started)
+
+    return summarize(samples)
+
+"""
+e.g. measure_each(db.delete, [("tags", ("id = ?", (1,))), ...])
+
+For operations that consume their inputs, such as deleting the rows an
+earlier benchmark inserted, so there is no warmup.
+"""
+def measure_each(func, calls):
+    samples = list()
+    for args in calls:
+        started = perf_counter_ns()
+        func(*args)
+        samples.append(perf_counter_ns() - started)
+
+    return summarize(samples)
+
+def summarize(samples):
+    ordered = sorted(samples)
+    total = sum(ordered)
+
+    stats = dict()
+    stats["ops"] = len(ordered)
+    stats["seconds"] = total / 1e9
+    stats["ops_per_sec"] = len(ordered) / (total / 1e9) if total else None
+    stats["mean_ms"] = mean(ordered) / 1e6 if ordered else None
+    stats["p50_ms"] = _percentile(ordered, 0.50)
+    stats["p95_ms"] = _percentile(ordered, 0.95)
+    stats["p99_ms"] = _percentile(ordered, 0.99)
+    stats["max_ms"] = ordered[-1] / 1e6 if ordered else None
+    return stats
+
+def _percentile(ordered, fraction):
+    if len(ordered) == 0:
+        return None
+
+    position = min(int(len(ordered) * fraction), len(ordered) - 1)
+    return ordered[position] / 1e6
+
+"""
+e.g. compare(results, baseline, threshold=0.1)
+     -> {"sqlite.lookup": {"baseline_ms": 0.02, "current_ms": 0.03,
+         "change": 0.5, "regression": True}, ...}
+
+Compares the median of every benchmark both runs have, a change above
+`threshold` (as a fraction of the baseline) is a regression.
+"""
+def compare(results, baseline, threshold=0.1):
+    comparison = dict()
+    for name, stats in results.items():
+        previous = baseline.get(name)
+        if previous is None:
+            continue
+
+        before = previous.get("p50_ms")
+        after = stats.get("p50_ms")
+        if not before or after is None:
+            continue
+
+        change = (after - before) / before
+        entry = dict()
+        entry["baseline_ms"] = before
+        entry["current_ms"] = after
+        entry["change"] = change
+        entry["regression"] = change > threshold
+        comparison[name] = entry
+
+    return comparison
@@ -0,0 +1,392 @@
+from database.sqlite import SQLite, BusyError, busy
+
+from os import cpu_count
+from time import sleep
+from random import uniform
+from queue import Queue
+from asyncio import (Lock, gather, get_running_loop, shield,
+    wrap_future)
+from functools import partial
+from threading import Lock as ThreadLock
+from sqlite3 import OperationalError
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+Reads are spread over a pool of read-only connections, while every write is
+serialized through a single writer connection on its own thread, matching
+SQLite's one-writer-many-readers model under WAL.
+
+e.g.
+    db = AsyncSQLite("test.db")
+    await db.insert("test", {"value": "abc"})
+    await db.lookup("test", ["id", "value"])
+    await db.write(SQLite.insert, "test", {"value": "xyz"})
+
+With `group_commit` set, single-row writes arriving within `group_window`
+seconds of each other, up to `group_size` of them, share one transaction and
+one fsync. Each runs under its own savepoint so a failing write only rolls
+back itself and its caller still gets its own result or error.
+
+Streams hold their connection until the consumer stops reading, so they get
+their own connections, opened on demand up to `streams` of them, instead of
+taking readers out of the pool the read executor draws from.
+"""
+class AsyncSQLite:
+    def __init__(self, db_file, readers=None, debug=False,
+        cached_statements=128, group_commit=False, group_window=0.002,
+        group_size=64, busy_timeout=5.0, retries=5, attach=None,
+        streams=None):
+        self.db_file = db_file
+        self.debug = debug
+
+        self.group_commit = group_commit
+        self.group_window = group_window
+        self.group_size = group_size
+        self._group = list()
+        self._group_timer = None
+        self._group_tasks = set()
+
+        settings = dict()
+        settings["debug"] = debug
+        settings["cached_statements"] = cached_statements
+        settings["busy_timeout"] = busy_timeout
+        settings["retries"] = retries
+        settings["attach"] = attach
+
+        self.writer = SQLite(db_file, **settings)
+        self._settings = settings
+        self._hooks = list()
+        # Keeps other writes out while a session holds the writer
+        self.gate = Lock()
+        self._write_executor = ThreadPoolExecutor(max_workers=1,
+            thread_name_prefix="sqlite-writer")
+
+        if readers is None:
+            readers = cpu_count() or 1
+
+        self.readers = Queue()
+        self.streamers = Queue()
+        self.stream_limit = readers if streams is None else streams
+        self._stream_count = 0
+        self._stream_lock = ThreadLock()
+        self._read_executor = ThreadPoolExecutor(max_workers=readers,
+            thread_name_prefix="sqlite-reader")
+
+        # An in-memory database cannot be shared, so reads use the writer
+        if self.writer.memory:
+            self._read_executor = self._write_executor
+            self.readers.put(self.writer)
+            return
+
+        for _ in range(readers):
+            reader = SQLite(db_file, readonly=True, **settings)
+            if reader.memory:
+                reader.stop()
+                continue
+
+            self.readers.put(reader)
+
+        if self.readers.empty():
+            self._read_executor = self._write_executor
+            self.readers.put(self.writer)
+
+    def _read(self, func, *args, **kwargs):
+        reader = self.readers.get()
+        try:
+            return func(reader, *args, **kwargs)
+
+        finally:
+            self.readers.put(reader)
+
+    def _write(self, func, *args, **kwargs):
+        return self._retry(self._transaction, func, *args, **kwargs)
+
+    def _transaction(self, func, *args, **kwargs):
+        with self.writer.transaction():
+            # Taking the write lock up front lets busy_timeout wait for it
+            if not self.writer.connection.in_transaction:
+                self.writer.connection.execute("BEGIN IMMEDIATE")
+
+            return func(self.writer, *args, **kwargs)
+
+    # A busy transaction was rolled back as a whole, so it is safe to rerun
+    def _retry(self, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+
+            except BusyError:
+                if attempt >= self.writer.retries:
+                    raise
+
+            except OperationalError as e:
+                if not busy(e):
+                    raise
+
+                if attempt >= self.writer.retries:
+                    raise BusyError(str(e)) from e
+
+            sleep(self.writer.backoff * 2 ** attempt * uniform(0.5, 1.5))
+            attempt = attempt + 1
+
+    async def read(self, func, *args, **kwargs):
+        loop = get_running_loop()
+        call = partial(self._read, func, *args, **kwargs)
+        return await loop.run_in_executor(self._read_executor, call)
+
+    async def write(self, func, *args, **kwargs):
+        loop = get_running_loop()
+        call = partial(self._write, func, *args, **kwargs)
+        async with self.gate:
+            return await loop.run_in_executor(self._write_executor, call)
+
+    """
+    e.g. await db.group(SQLite.insert, "test", {"value": "abc"}) -> True
+
+    Queues the write for the next group commit, or writes it on its own when
+    `group_commit` is off.
+    """
+    async def group(self, func, *args, **kwargs):
+        if not self.group_commit:
+            return await self.write(func, *args, **kwargs)
+
+        loop = get_running_loop()
+        future = loop.create_future()
+        self._group.append((partial(func, self.writer, *args, **kwargs),
+            future))
+        if len(self._group) >= self.group_size:
+            self._flush_group()
+
+        elif self._group_timer is None:
+            self._group_timer = loop.call_later(self.group_window,
+                self._flush_group)
+
+        return await future
+
+    def _flush_group(self):
+        if self._group_timer is not None:
+            self._group_timer.cancel()
+            self._group_timer = None
+
+        calls = self._group
+        self._group = list()
+        if len(calls) == 0:
+            return
+
+        task = get_running_loop().create_task(self._commit_group(calls))
+        self._group_tasks.add(task)
+        task.add_done_callback(self._group_tasks.discard)
+
+    async def _commit_group(self, calls):
+        loop = get_running_loop()
+        call = partial(self._retry, self._write_group,
+            [call for call, _ in calls])
+        try:
+            async with self.gate:
+                results = await loop.run_in_executor(self._write_executor,
+                    call)
+
+        except Exception as e:
+            for _, future in calls:
+                if not future.done():
+                    future.set_exception(e)
+
+            return
+
+        for (_, future), (result, error) in zip(calls, results):
+            if future.done():
+                continue
+
+            if error is not None:
+                future.set_exception(error)
+
+            else:
+                future.set_result(result)
+
+    def _write_group(self, calls):
+        results = list()
+        connection = self.writer.connection
+        with self.writer.transaction():
+            if not connection.in_transaction:
+                connection.execute("BEGIN IMMEDIATE")
+
+            for call in calls:
+                connection.execute("SAVEPOINT group_write")
+                result, error = None, None
+                try:
+                    result = call()
+
+                except Exception as e:
+                    error = e
+
+                # execute() reports failures as False rather than raising
+                if error is not None or result is False:
+                    connection.execute("ROLLBACK TO group_write")
+
+                connection.execute("RELEASE group_write")
+                results.append((result, error))
+
+        return results
+
+    async def flush(self):
+        self._flush_group()
+        if len(self._group_tasks) > 0:
+            await gather(*self._group_tasks)
+
+    """
+    e.g.
+        async with db.session(defer_foreign_keys=True) as run:
+            await run(SQLite.import_rows, "test", ["value"], [("abc",)])
+
+    One writer transaction spanning many awaited calls, committed when the
+    block exits and rolled back if it raises.
+    """
+    @asynccontextmanager
+    async def session(self, defer_foreign_keys=False):
+        loop = get_running_loop()
+
+        async def run(func, *args, **kwargs):
+            call = partial(func, self.writer, *args, **kwargs)
+            return await loop.run_in_executor(self._write_executor, call)
+
+        # Runs after `begin` on the writer thread, so its outcome is known
+        def rollback(writer):
+            if begun.exception() is None:
+                writer.end(False)
+
+        # A cancelled caller must not leave the writer inside a transaction,
+        # so beginning and ending are shielded from cancellation
+        async with self.gate:
+            begun = self._write_executor.submit(self.writer.begin,
+                defer_foreign_keys)
+            try:
+                await shield(wrap_future(begun))
+                yield run
+
+            except BaseException:
+                await shield(run(rollback))
+                raise
+
+            await shield(run(SQLite.end, True))
+
+    async def transaction(self, func, *args, **kwargs):
+        return await self.write(func, *args, **kwargs)
+
+    async def lookup(self, table, search, where=None, limit=None):
+        return await self.read(SQLite.lookup, table, search, where, limit)
+
+    def iter_lookup(self, table, search, where=None, limit=None):
+        return self.stream(SQLite.iter_lookup, table, search, where, limit)
+
+    async def lookup_one(self, table, search, where=None):
+        return await self.read(SQLite.lookup_one, table, search, where)
+
+    async def lookup_all(self, table, where=None, limit=None):
+        return await self.read(SQLite.lookup_all, table, where, limit)
+
+    async def page(self, table, search, where=None, after=None, limit=None):
+        return await self.read(SQLite.page, table, search, where, after, limit)
+
+    """
+    Synchronous generator holding one reader for as long as it is consumed,
+    meant for streaming responses that iterate it in a worker thread.
+    """
+    def stream(self, func, *args, **kwargs):
+        # An in-memory database only has the one connection to read from
+        if self.writer.memory:
+            pool, reader = self.readers, self.readers.get()
+
+        else:
+            pool, reader = self.streamers, self._streamer()
+
+        try:
+            yield from func(reader, *args, **kwargs)
+
+        finally:
+            pool.put(reader)
+
+    def _streamer(self):
+        with self._stream_lock:
+            opening = self.streamers.empty()
+            opening = opening and self._stream_count < self.stream_limit
+            if opening:
+                self._stream_count = self._stream_count + 1
+
+        if not opening:
+            return self.streamers.get()
+
+        streamer = SQLite(self.db_file, readonly=True, **self._settings)
+        for event, callback in self._hooks:
+            streamer.hook(event, callback)
+
+        return streamer
+
+    async def tree(self, table, root, search, parent="parent_id",
+        direction="descendants", depth=None):
+        return await self.read(SQLite.tree, table, root, search, parent,
+            direction, depth)
+
+    async def search(self, table, fts_table, search, query, limit=20,
+        offset=0):
+        return await self.read(SQLite.search, table, fts_table, search, query,
+            limit, offset)
+
+    async def explain(self, table, search, where=None):
+        return await self.read(SQLite.explain, table, search, where)
+
+    # Registers the hook on the writer and every reader connection
+    def hook(self, event, callback):
+        self._hooks.append((event, callback))
+        connections = [self.writer, *self.readers.queue, *self.streamers.queue]
+        for connection in {id(c): c for c in connections}.values():
+            connection.hook(event, callback)
+
+    async def versions(self, tables):
+        return await self.read(SQLite.versions, tables)
+
+    async def get_all_tables(self):
+        return await self.read(SQLite.get_all_tables)
+
+    async def has_table(self, name):
+        if name in self.writer.tables:
+            return True
+
+        # A reader's catalog may still list a table the writer dropped
+        return name in await self.read(SQLite.get_all_tables)
+
+    async def insert(self, table, insertion):
+        return await self.group(SQLite.insert, table, insertion)
+
+    async def insert_many(self, table, insertions):
+        return await self.write(SQLite.insert_many, table, insertions)
+
+    async def upsert(self, table, insertion, keys, update=None):
+        return await self.group(SQLite.upsert, table, insertion, keys,
+            update)
+
+    async def ensure_many(self, table, insertions, keys):
+        return await self.write(SQLite.ensure_many, table, insertions, keys)
+
+    async def update(self, table, modification, where):
+        return await self.group(SQLite.update, table, modification, where)
+
+    async def delete(self, table, where):
+        return await self.group(SQLite.delete, table, where)
+
+    async def drop_table(self, name):
+        return await self.write(SQLite.drop_table, name)
+
+    def stop(self):
+        self._write_executor.shutdown(wait=True)
+        self._read_executor.shutdown(wait=True)
+        while not self.readers.empty():
+            reader = self.readers.get()
+            if reader is not self.writer:
+                reader.stop()
+
+        while not self.streamers.empty():
+            self.streamers.get().stop()
+
+        self.writer.stop()
@@ -0,0 +1,108 @@
+from helpers.general import eprint
+from helpers.datetime import now
+
+from threading import Thread, Event
+from traceback import format_exc
+
+"""
+Runs `SQLite.backup` on a background thread every `interval` seconds, or on
+demand through `run_now`. An interval of `None` only backs up on demand.
+Given a list of databases, such as the files of a `RoutedSQLite`, each one
+is backed up in turn and the first is the one reported in `last_file`.
+
+Every worker process gets a scheduler, but only the one holding the first
+database's `claim_lock("backup")` backs up on the interval. The others still
+back up on demand.
+
+e.g.
+    scheduler = BackupScheduler(db.writer, "/var/backups", interval=3600)
+    scheduler.start()
+    scheduler.status()
+"""
+class BackupScheduler:
+    def __init__(self, db, backup_dir=None, interval=None, backups=3,
+        pages=256, sleep=0.05):
+        self.dbs = list(db) if isinstance(db, (list, tuple)) else [db]
+        self.db = self.dbs[0]
+        self.backup_dir = backup_dir
+        self.interval = interval
+        self.backups = backups
+        self.pages = pages
+        self.sleep = sleep
+
+        self.last_file = None
+        self.last_files = list()
+        self.last_started = None
+        self.last_finished = None
+        self.scheduled = False
+
+        self._wake = Event()
+        self._stopped = Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._thread = Thread(target=self._run, name="sqlite-backup",
+            daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def run_now(self):
+        self._wake.set()
+
+    def status(self):
+        status = dict()
+        status["interval"] = self.interval
+        status["running"] = self._thread is not None
+        status["scheduled"] = self.scheduled
+        status["last_file"] = self.last_file
+        if len(self.dbs) > 1:
+            status["last_files"] = self.last_files
+
+        status["last_started"] = self.last_started
+        status["last_finished"] = self.last_finished
+        status["progress"] = self.db.backup_progress
+        return status
+
+    def backup(self):
+        self.last_started = now()
+        backup_files = list()
+        for db in self.dbs:
+            try:
+                backup_file = db.backup(self.backup_dir, self.backups,
+                    pages=self.pages, sleep=self.sleep)
+
+            except Exception:
+                eprint(format_exc())
+                backup_file = None
+
+            backup_files.append(backup_file)
+
+        if backup_files[0] is not None:
+            self.last_file = backup_files[0]
+
+        self.last_files = backup_files
+        self.last_finished = now()
+        return backup_files[0]
+
+    def _run(self):
+        with self.db.claim_lock("backup") as claimed:
+            self.scheduled = claimed and self.interval is not None
+            interval = self.interval if claimed else None
+            while not self._stopped.is_set():
+                self._wake.wait(interval)
+                if self._stopped.is_set():
+                    break
+
+                self._wake.clear()
+                self.backup()
+
+        self.scheduled = False
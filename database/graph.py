@@ -0,0 +1,126 @@
+"""
+Rows for several tables inserted together, linked by symbolic references
+instead of ids the client does not know yet. A row names itself with "$id"
+and other rows point at it with {"$ref": name} in place of a value. A row
+with "$on" set to one of its table's unique keys reuses the row already
+holding that key, if there is one, instead of failing on the conflict.
+
+e.g.
+    plan = plan_graph(schemas, {
+        "notes": [{"$id": "note", "title": "abc", ...}],
+        "data": [{"$id": "data", "raw_data": "xyz"}],
+        "tags": [{"$id": "sql", "tag": "sql", "$on": ["tag"]}],
+        "tagmap": [{"id": 1, "note_id": {"$ref": "note"},
+            "tag_id": {"$ref": "sql"}, "data_id": {"$ref": "data"}}]})
+
+    async with db.session() as run:
+        ids, refs = await run(insert_graph, plan)
+
+    -> {"data": [1], "notes": [1], "tags": [1], "tagmap": [1]},
+       {"data": 1, "note": 1, "sql": 1}
+"""
+LABEL = "$id"
+REF = "$ref"
+ON = "$on"
+
+class GraphError(ValueError):
+    pass
+
+def ref(value):
+    if isinstance(value, dict) and len(value) == 1 and REF in value:
+        return value[REF]
+
+    return None
+
+"""
+e.g. stub_refs({"note_id": {"$ref": "note"}, "tag_id": 2})
+     -> {"note_id": 0, "tag_id": 2}
+
+Stands in for the ids a row will get, so it can be validated beforehand.
+"""
+def stub_refs(row, stub=0):
+    return {field: stub if ref(value) is not None else value
+        for field, value in row.items()}
+
+"""
+e.g. plan_graph(schemas, graph) -> [("notes", 0, "note", None, {...}), ...]
+
+Orders the rows so every table comes after the tables in its `_needs`, and
+rows of one table keep their given order, so a reference can only point at
+a row inserted before it. Fields set to None are left out, as with
+/api/db/put.
+"""
+def plan_graph(schemas, graph):
+    order = schemas.order()
+    unknown = [table for table in graph if table not in order]
+    if len(unknown) > 0:
+        raise GraphError(f"Unknown tables: {', '.join(unknown)}")
+
+    plan = list()
+    labels = set()
+    for table in order:
+        rows = graph.get(table)
+        if rows is None:
+            continue
+
+        if not isinstance(rows, list):
+            raise GraphError(f"'{table}' takes a list of rows")
+
+        for index, row in enumerate(rows):
+            if not isinstance(row, dict):
+                raise GraphError(f"{table}[{index}] is not an object")
+
+            row = {field: value for field, value in row.items()
+                if value is not None}
+            label = row.pop(LABEL, None)
+            on = row.pop(ON, None)
+            if on is not None and on not in schemas.unique_keys(table):
+                raise GraphError(f"{table}[{index}].{ON} is not a unique "
+                    f"key of '{table}'")
+
+            for field, value in row.items():
+                name = ref(value)
+                if name is not None and name not in labels:
+                    raise GraphError(f"{table}[{index}].{field} references "
+                        f"'{name}', which is not inserted before it")
+
+            if label is not None:
+                if not isinstance(label, str) or label in labels:
+                    raise GraphError(f"{table}[{index}] has an invalid or "
+                        f"repeated {LABEL}")
+
+                labels.add(label)
+
+            plan.append((table, index, label, on, row))
+
+    return plan
+
+"""
+Runs on the writer inside a transaction, raising on the first failed row so
+the caller's transaction rolls the whole graph back.
+"""
+def insert_graph(db, plan):
+    ids = dict()
+    refs = dict()
+    for table, index, label, on, row in plan:
+        insertion = dict()
+        for field, value in row.items():
+            name = ref(value)
+            insertion[field] = value if name is None else refs[name]
+
+        db.last_error = None
+        if on is None:
+            row_id = db.insert_id(table, insertion)
+
+        else:
+            row_id = db.upsert(table, insertion, on, update=list())
+
+        if row_id is None:
+            reason = "" if db.last_error is None else f": {db.last_error}"
+            raise GraphError(f"Could not insert {table}[{index}]{reason}")
+
+        ids.setdefault(table, list()).append(row_id)
+        if label is not None:
+            refs[label] = row_id
+
+    return ids, refs
@@ -0,0 +1,315 @@
+"""
+Read queries compiled from request parameters. Every identifier is checked
+against the table's schema fields, and values are always bound, so the SQL
+text only ever holds names the schema declared.
+
+e.g.
+    compile_aggregate("notes", {"id": "integer", "created_at": "timestamp"},
+        metrics=["count"], bucket=("created_at", "month"))
+    -> ("SELECT strftime('%Y-%m-01', created_at) AS created_at, "
+        "count(*) AS count FROM notes GROUP BY 1 ORDER BY 1 LIMIT ?",
+        (10000,), ["created_at", "count"])
+"""
+
+class QueryError(ValueError):
+    pass
+
+# Each bucket is the start of its period, as text that sorts in time order
+BUCKETS = dict()
+BUCKETS["minute"] = "strftime('%Y-%m-%d %H:%M:00', {})"
+BUCKETS["hour"] = "strftime('%Y-%m-%d %H:00:00', {})"
+BUCKETS["day"] = "date({})"
+BUCKETS["week"] = "date({}, '-6 days', 'weekday 1')"
+BUCKETS["month"] = "strftime('%Y-%m-01', {})"
+BUCKETS["year"] = "strftime('%Y-01-01', {})"
+
+TIMESTAMPS = {"timestamp", "date", "datetime"}
+NUMBERS = {"integer", "int", "float", "real", "number"}
+TEXTS = {"text", "varchar", "char"}
+
+# Functions and the field types they accept, None for any type
+FUNCTIONS = dict()
+FUNCTIONS["count"] = None
+FUNCTIONS["min"] = None
+FUNCTIONS["max"] = None
+FUNCTIONS["sum"] = NUMBERS
+FUNCTIONS["avg"] = NUMBERS
+
+MAX_LIMIT = 10_000
+
+def _field(types, field):
+    if field not in types:
+        raise QueryError(f"Unknown field '{field}'")
+
+    return field
+
+"""
+e.g. parse_metric("count") -> ("count", None)
+     parse_metric("max:created_at") -> ("max", "created_at")
+"""
+def parse_metric(metric):
+    function, _, field = metric.partition(":")
+    if function not in FUNCTIONS:
+        raise QueryError(f"Unknown function '{function}'")
+
+    if function != "count" and field == "":
+        raise QueryError(f"'{function}' needs a field, e.g. {function}:id")
+
+    return function, field or None
+
+def _metric(types, function, field):
+    if field is None:
+        return "count(*)", "count"
+
+    _field(types, field)
+    accepted = FUNCTIONS[function]
+    if accepted is not None and types[field] not in accepted:
+        raise QueryError(f"'{function}' needs a number, '{field}' is a "
+            f"{types[field]}")
+
+    # Counting a field counts its distinct values, e.g. notes per tag
+    if function == "count":
+        return f"count(DISTINCT {field})", f"count_{field}"
+
+    return f"{function}({field})", f"{function}_{field}"
+
+"""
+e.g. compile_aggregate("tagmap", types, group_by=["tag_id"],
+        metrics=["count:note_id"], order="-count_note_id", limit=10)
+
+Groups by `group_by` fields and, with `bucket` as (field, unit), by the
+period a timestamp falls in. Results are ordered by the groups unless
+`order` names an output column, descending when prefixed with "-".
+Returns the query, its values and the output column names.
+"""
+def compile_aggregate(table, types, group_by=None, metrics=None,
+    bucket=None, order=None, limit=None, where=None):
+    columns = list()
+    aliases = list()
+    for field in group_by or list():
+        columns.append(_field(types, field))
+        aliases.append(field)
+
+    if bucket is not None:
+        field, unit = bucket
+        _field(types, field)
+        if unit not in BUCKETS:
+            raise QueryError(f"Unknown bucket '{unit}', expected one of "
+                f"{', '.join(BUCKETS)}")
+
+        if types[field] not in TIMESTAMPS:
+            raise QueryError(f"Only timestamps can be bucketed, '{field}' "
+                f"is a {types[field]}")
+
+        columns.append(BUCKETS[unit].format(field))
+        aliases.append(field)
+
+    groups = len(columns)
+    for metric in metrics or ["count"]:
+        column, alias = _metric(types, *parse_metric(metric))
+        columns.append(column)
+        aliases.append(alias)
+
+    if len(set(aliases)) != len(aliases):
+        raise QueryError("Every group and metric can only be asked once")
+
+    selected = ", ".join(f"{column} AS {alias}"
+        for column, alias in zip(columns, aliases))
+    executor = f"SELECT {selected} FROM {table}"
+    values = tuple()
+    if where is not None:
+        executor = f"{executor} WHERE {where[0]}"
+        values = values + tuple(where[1])
+
+    positions = ", ".join(str(index + 1) for index in range(groups))
+    if groups > 0:
+        executor = f"{executor} GROUP BY {positions}"
+
+    if order is not None:
+        direction = "DESC" if order.startswith("-") else "ASC"
+        alias = order.lstrip("-")
+        if alias not in aliases:
+            raise QueryError(f"Cannot order by '{alias}', expected one of "
+                f"{', '.join(aliases)}")
+
+        executor = f"{executor} ORDER BY {aliases.index(alias) + 1} "
+        executor = f"{executor}{direction}"
+
+    elif groups > 0:
+        executor = f"{executor} ORDER BY {positions}"
+
+    if limit is None or limit < 0 or limit > MAX_LIMIT:
+        limit = MAX_LIMIT
+
+    executor = f"{executor} LIMIT ?"
+    values = values + (limit,)
+    return executor, values, aliases
+
+RANGES = dict()
+RANGES["gt"] = ">"
+RANGES["gte"] = ">="
+RANGES["lt"] = "<"
+RANGES["lte"] = "<="
+
+MAX_DEPTH = 16
+MAX_IN = 1000
+
+"""
+e.g. compile_filter(types, {"and": [
+        {"eq": {"tag_id": 1}},
+        {"range": {"created_at": {"gte": "2020-01-01", "lt": "2021-01-01"}}},
+        {"or": [{"prefix": {"title": "sql"}}, {"in": {"id": [1, 2]}}]}]})
+     -> ("(tag_id = ?) AND (created_at >= ? AND created_at < ?) AND "
+         "((title >= ? AND title < ?) OR (id IN (?,?)))",
+         (1, "2020-01-01", "2021-01-01", "sql", "sqm", 1, 2))
+
+Every leaf compiles to a comparison an index on its field can serve, a
+prefix included, and fields are visited in sorted order so one filter
+shape always gives the same cached statement.
+"""
+def compile_filter(types, node, depth=0):
+    if depth > MAX_DEPTH:
+        raise QueryError(f"Filters nest at most {MAX_DEPTH} deep")
+
+    if not isinstance(node, dict) or len(node) != 1:
+        raise QueryError('Each filter is an object with one operator, e.g. '
+            '{"eq": {"id": 1}}')
+
+    kind, value = next(iter(node.items()))
+    if kind in ("and", "or"):
+        if not isinstance(value, list) or len(value) == 0:
+            raise QueryError(f"'{kind}' takes a list of filters")
+
+        parts = [compile_filter(types, child, depth + 1) for child in value]
+        joiner = " AND " if kind == "and" else " OR "
+        where_query = joiner.join(f"({part[0]})" for part in parts)
+        return where_query, sum((part[1] for part in parts), tuple())
+
+    if kind not in CONDITIONS:
+        raise QueryError(f"Unknown operator '{kind}', expected one of "
+            f"and, or, {', '.join(CONDITIONS)}")
+
+    if not isinstance(value, dict) or len(value) == 0:
+        raise QueryError(f"'{kind}' takes an object of fields")
+
+    parts = [CONDITIONS[kind](_condition(types, kind, field), value[field])
+        for field in sorted(value)]
+    where_query = " AND ".join(part[0] for part in parts)
+    return where_query, sum((part[1] for part in parts), tuple())
+
+def _condition(types, kind, field):
+    _field(types, field)
+    accepted = ACCEPTS.get(kind)
+    if accepted is not None and types[field] not in accepted:
+        raise QueryError(f"'{kind}' needs text, '{field}' is a "
+            f"{types[field]}")
+
+    return field
+
+def _scalar(value):
+    if isinstance(value, (list, dict)):
+        raise QueryError(f"Expected a single value, got {value!r}")
+
+    # A lone surrogate cannot be bound as UTF-8
+    if isinstance(value, str):
+        try:
+            value.encode("utf-8")
+
+        except UnicodeEncodeError:
+            raise QueryError(f"Invalid text {value!r}")
+
+    return value
+
+def _eq(field, value):
+    if value is None:
+        return f"{field} IS NULL", tuple()
+
+    return f"{field} = ?", (_scalar(value),)
+
+def _in(field, value):
+    if not isinstance(value, list) or len(value) > MAX_IN:
+        raise QueryError(f"'in' takes a list of at most {MAX_IN} values")
+
+    # Nothing is in an empty list
+    if len(value) == 0:
+        return "0", tuple()
+
+    places = ",".join(["?"] * len(value))
+    return f"{field} IN ({places})", tuple(_scalar(item) for item in value)
+
+def _range(field, value):
+    if not isinstance(value, dict) or len(value) == 0:
+        raise QueryError(f"'range' takes bounds, e.g. {{\"gte\": 1}}")
+
+    clauses = list()
+    values = tuple()
+    for bound in sorted(value):
+        if bound not in RANGES:
+            raise QueryError(f"Unknown bound '{bound}', expected one of "
+                f"{', '.join(RANGES)}")
+
+        clauses.append(f"{field} {RANGES[bound]} ?")
+        values = values + (_scalar(value[bound]),)
+
+    return " AND ".join(clauses), values
+
+"""
+e.g. _successor("sql") -> "sqm"
+     _successor("a\U0010ffff") -> "b"
+
+The least text greater than everything starting with `prefix`, in SQLite's
+binary order, which is code point order, or None when there is none.
+"""
+def _successor(prefix):
+    while len(prefix) > 0:
+        point = ord(prefix[-1]) + 1
+        # Surrogates are not text, the next character is past them
+        if 0xD800 <= point <= 0xDFFF:
+            point = 0xE000
+
+        if point <= 0x10FFFF:
+            return prefix[:-1] + chr(point)
+
+        prefix = prefix[:-1]
+
+    return None
+
+def _prefix(field, value):
+    if not isinstance(value, str):
+        raise QueryError("'prefix' takes a string")
+
+    if value == "":
+        return f"{field} IS NOT NULL", tuple()
+
+    # A range rather than LIKE, which cannot use an index by default
+    value = _scalar(value)
+    upper = _successor(value)
+    if upper is None:
+        return f"{field} >= ?", (value,)
+
+    return f"{field} >= ? AND {field} < ?", (value, upper)
+
+CONDITIONS = dict()
+CONDITIONS["eq"] = _eq
+CONDITIONS["in"] = _in
+CONDITIONS["range"] = _range
+CONDITIONS["prefix"] = _prefix
+
+# Operators and the field types they accept, missing for any type. A number
+# compared against a text prefix never matches
+ACCEPTS = dict()
+ACCEPTS["prefix"] = TEXTS
+
+"""
+e.g. project(["id", "title", "contents"], ["id", "title"]) -> ["id", "title"]
+"""
+def project(fields, select):
+    if select is None or len(select) == 0:
+        return fields
+
+    unknown = [field for field in select if field not in fields]
+    if len(unknown) > 0:
+        raise QueryError(f"Unknown fields: {', '.join(unknown)}")
+
+    # Duplicates would only repeat a column
+    return list(dict.fromkeys(select))
@@ -0,0 +1,126 @@
+from database.sqlite import SQLite
+from database.async_sqlite import AsyncSQLite
+
+from contextlib import asynccontextmanager, AsyncExitStack
+
+"""
+e.g. check_placement(schemas, {"data": "data.db"}, "x.db")
+     -> ValueError: 'tagmap' in x.db references 'data' in data.db
+
+SQLite only enforces foreign keys, and only fires triggers, within one file,
+so tables linked by a reference have to be placed together.
+"""
+def check_placement(schemas, placement, default_file):
+    place = lambda table: placement.get(table, default_file)
+    for table in schemas.order():
+        for referenced in sorted(schemas.references(table)):
+            if place(table) != place(referenced):
+                raise ValueError(f"'{table}' in {place(table)} references "
+                    f"'{referenced}' in {place(referenced)}")
+
+"""
+Tables spread over several database files, each with its own writer thread,
+write lock and WAL, so writes to tables in different files do not queue
+behind one another. Tables not in `placement` live in `db_file`.
+
+Writes are routed to the file of the table they are given first. Reads go
+through `db_file`, whose connections attach every other file, so queries
+join across files by plain table names. Sessions also run on `db_file`'s
+writer while holding every file's gate, though under WAL a commit is only
+atomic within each file.
+
+e.g.
+    db = RoutedSQLite("x.db", {"events": "events.db"})
+    await db.insert("events", {"value": "abc"})  # events.db writer
+    await db.insert("test", {"value": "xyz"})    # x.db writer
+    await db.lookup("events", ["id", "value"])   # x.db reader
+"""
+class RoutedSQLite:
+    def __init__(self, db_file, placement=None, **settings):
+        self.db_file = db_file
+        self.placement = dict() if placement is None else dict(placement)
+
+        files = list()
+        for table_file in self.placement.values():
+            if table_file != db_file and table_file not in files:
+                files.append(table_file)
+
+        # Other files come first, so they exist by the time they are attached
+        shards = dict()
+        shard_settings = {**settings, "readers": 1}
+        for table_file in files:
+            shards[table_file] = AsyncSQLite(table_file, **shard_settings)
+
+        self.main = AsyncSQLite(db_file, attach=files, **settings)
+        self.shards = {db_file: self.main, **shards}
+        self.writer = self.main.writer
+
+    def file(self, table):
+        return self.placement.get(table, self.db_file)
+
+    def shard(self, table):
+        return self.shards[self.file(table)]
+
+    # Everything not routed below is a read, served by the main file
+    def __getattr__(self, name):
+        return getattr(self.main, name)
+
+    async def write(self, func, table, *args, **kwargs):
+        return await self.shard(table).write(func, table, *args, **kwargs)
+
+    async def group(self, func, table, *args, **kwargs):
+        return await self.shard(table).group(func, table, *args, **kwargs)
+
+    async def transaction(self, func, table, *args, **kwargs):
+        return await self.write(func, table, *args, **kwargs)
+
+    @asynccontextmanager
+    async def session(self, defer_foreign_keys=False):
+        async with AsyncExitStack() as stack:
+            for table_file in sorted(self.shards):
+                if table_file != self.db_file:
+                    await stack.enter_async_context(
+                        self.shards[table_file].gate)
+
+            async with self.main.session(defer_foreign_keys) as run:
+                yield run
+
+    # The main writer only sees other files' DDL by reloading its catalog
+    def refresh_catalog(self):
+        return self.writer.get_all_tables()
+
+    def hook(self, event, callback):
+        for shard in self.shards.values():
+            shard.hook(event, callback)
+
+    async def insert(self, table, insertion):
+        return await self.shard(table).insert(table, insertion)
+
+    async def insert_many(self, table, insertions):
+        return await self.shard(table).insert_many(table, insertions)
+
+    async def upsert(self, table, insertion, keys, update=None):
+        return await self.group(SQLite.upsert, table, insertion, keys,
+            update)
+
+    async def ensure_many(self, table, insertions, keys):
+        return await self.shard(table).ensure_many(table, insertions, keys)
+
+    async def update(self, table, modification, where):
+        return await self.shard(table).update(table, modification, where)
+
+    async def delete(self, table, where):
+        return await self.shard(table).delete(table, where)
+
+    async def drop_table(self, name):
+        dropped = await self.shard(name).drop_table(name)
+        await self.main.write(SQLite.get_all_tables)
+        return dropped
+
+    async def flush(self):
+        for shard in self.shards.values():
+            await shard.flush()
+
+    def stop(self):
+        for shard in self.shards.values():
+            shard.stop()
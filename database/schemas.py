@@ -2,13 +2,56 @@ from helpers.datetime import now
 from helpers.encode import jots, jsto
 from helpers.general import generator, trap, eprint
 
-from pydantic import BaseModel, Field, create_model
+from pydantic import BaseModel, Field, create_model, VERSION as PYDANTIC
+from jsonschema.validators import validator_for
 
 import typing
+from os import replace, getpid
+from time import monotonic
 from pathlib import Path
+from hashlib import sha256
 from datetime import datetime
 from copy import deepcopy
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from collections.abc import Mapping
+
+CompiledSchema = namedtuple("CompiledSchema", ["schema", "json", "validator"])
+
+# Bump when the layout of the compiled artifact changes
+ARTIFACT_VERSION = 1
+ARTIFACT_STATE = ("raw", "model", "sql", "sql_meta", "sql_index", "sql_fts",
+    "fts", "graph")
+
+"""
+Pydantic models built on first use of each table rather than all at once.
+"""
+class LazyModels(Mapping):
+    def __init__(self, schemas):
+        self.schemas = schemas
+        self.built = dict()
+
+    def __getitem__(self, name):
+        model = self.built.get(name)
+        if model is None:
+            if name not in self.schemas.model:
+                raise KeyError(name)
+
+            model = self.schemas._build_model(name)
+            self.built[name] = model
+
+        return model
+
+    def __iter__(self):
+        return iter(self.schemas.model)
+
+    def __len__(self):
+        return len(self.schemas.model)
+
+    def __contains__(self, name):
+        return name in self.schemas.model
+
+    def clear(self):
+        self.built.clear()
 
 """
 _id = "id INTEGER NOT NULL PRIMARY KEY"
@@ -43,20 +86,33 @@ tables["tagmap"] = [
 """
 
 class Schemas:
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, check_interval=1.0):
         self.debug = debug
+        self.check_interval = check_interval
 
         current_path = Path(__file__).parent.absolute()
         schema_path = current_path / ".." / "schemas"
         self.path = schema_path.resolve()
+        self.cache_path = self.path / ".compiled"
 
         self.raw = dict()
         self.model = defaultdict(dict)
         self.sql = defaultdict(list)
         self.sql_meta = defaultdict(list)
+        self.sql_index = defaultdict(list)
+        self.sql_fts = defaultdict(list)
+        self.fts = dict()
 
         self.graph = defaultdict(list)
 
+        self.models = LazyModels(self)
+        self.compiled = dict()
+        self.json_schemas = dict()
+        self.field_names = dict()
+        self.signature = None
+        self.digest = None
+        self._checked = monotonic()
+
         self.sql_map = dict()
         self.sql_map["integer"] = int
         self.sql_map["varchar"] = str
@@ -65,16 +121,321 @@ class Schemas:
 
         self.parse()
 
-    def create_tables(self, db):
-        all_tables = db.get_all_tables()
+    """
+    Estimate of the statement templates in use at once, `per_table` shapes
+    for each table and `extra` for filters and where clauses, used to size
+    the sqlite3 statement cache. Not a bound, free-form where clauses have
+    none, so the cache may still evict.
+    """
+    def statement_count(self, per_table=16, extra=64):
+        return len(self.sql) * per_table + extra
+
+    """
+    e.g. order() -> ["data", "notes", "tags", "tagmap"]
+
+    Tables sorted so each comes after everything in its `_needs`.
+    """
+    def order(self):
+        tables = sorted(set(self.sql) | set(self.graph))
+        needs = {table: set(self.graph.get(table, list())) for table in tables}
+        ordered = list()
+        while len(needs) > 0:
+            ready = sorted(table for table, needed in needs.items()
+                if len(needed & needs.keys()) == 0)
+
+            # A cycle in `_needs`, fall back to name order for the rest
+            if len(ready) == 0:
+                ready = sorted(needs)
+
+            for table in ready:
+                ordered.append(table)
+                needs.pop(table)
+
+        return ordered
+
+    """
+    e.g. unique_keys("tags") -> [["tag"], ["id"]]
+
+    Field lists that identify a row, usable as an ON CONFLICT target: unique
+    constraints, unique indexes without a WHERE clause, then the primary key.
+    """
+    def unique_keys(self, name):
+        spec = self.raw.get(name, dict())
+        sql = spec.get("_sql", dict())
+        keys = list()
+        if isinstance(sql.get("unique"), list):
+            keys.append(sql["unique"])
+
+        for parameters in sql.get("index", dict()).values():
+            if parameters.get("unique", False) and "where" not in parameters:
+                keys.append(parameters.get("fields", list()))
+
+        if isinstance(sql.get("primary_key"), list):
+            keys.append(sql["primary_key"])
+
+        for key, value in spec.items():
+            if key.startswith("_") or not isinstance(value, dict):
+                continue
+
+            if value.get("primary_key", False):
+                keys.append([key])
+
+        return [key for key in keys if len(key) > 0]
+
+    """
+    e.g. types("notes") -> {"id": "integer", "title": "varchar", ...}
+    """
+    def types(self, name):
+        types = dict()
+        for key, value in self.raw.get(name, dict()).items():
+            if key.startswith("_") or not isinstance(value, dict):
+                continue
+
+            if isinstance(value.get("type"), str):
+                types[key] = value["type"]
+
+        return types
+
+    """
+    e.g. references("tagmap") -> {"notes", "data", "tags"}
+
+    Other tables `name` points at through a foreign key or a field
+    reference, self references are left out.
+    """
+    def references(self, name):
+        spec = self.raw.get(name, dict())
+        referenced = set()
+        for key, value in spec.items():
+            if key.startswith("_") or not isinstance(value, dict):
+                continue
+
+            reference = value.get("references")
+            if isinstance(reference, dict):
+                referenced.add(reference.get("table", name))
+
+        foreign_keys = spec.get("_sql", dict()).get("foreign_key", dict())
+        for value in foreign_keys.values():
+            reference = value.get("references", dict())
+            referenced.add(reference.get("table", name))
+
+        referenced.discard(name)
+        return referenced
+
+    """
+    e.g. self_reference("data") -> "parent_id"
+
+    The field referencing its own table, which makes the table a tree.
+    """
+    def self_reference(self, name):
+        for key, value in self.raw.get(name, dict()).items():
+            if key.startswith("_") or not isinstance(value, dict):
+                continue
+
+            references = value.get("references")
+            if not isinstance(references, dict):
+                continue
+
+            if references.get("table", name) == name:
+                return key
+
+        return None
+
+    def create_tables(self, db, tables=None):
+        wanted = lambda name: tables is None or name in tables
         for name, fields in self.sql.items():
             meta_fields = self.sql_meta[name]
-            fields.extend(meta_fields)
+            if wanted(name) and not db.has_table(name):
+                db.create_table(name, fields + meta_fields)
+
+            if wanted(name):
+                db.track_versions(name)
+
+        # Indexes are applied idempotently, so existing tables pick up new ones
+        for name, indexes in self.sql_index.items():
+            if not wanted(name):
+                continue
+
+            for index in indexes:
+                db.execute(index)
+
+        for name, statements in self.sql_fts.items():
+            if not wanted(name):
+                continue
+
+            fts_table = self.fts[name]["table"]
+            exists = db.has_table(fts_table)
+            for statement in statements:
+                db.execute(statement)
+
+            # Index rows that were written before the search table existed
+            if not exists:
+                rebuild = f"INSERT INTO {fts_table}({fts_table}) VALUES(?)"
+                db.execute(rebuild, ("rebuild",), commit=True)
+
+    """
+    e.g. fields("tags") -> ["id", "tag"]
+    """
+    def fields(self, name):
+        field_names = self.field_names.get(name)
+        if field_names is None:
+            field_names = list(self.models[name].__fields__.keys())
+            self.field_names[name] = field_names
+
+        return field_names
+
+    def _digest(self):
+        digest = sha256(f"{ARTIFACT_VERSION}:{PYDANTIC}".encode())
+        for schema_file in sorted(self.path.glob("*.json")):
+            digest.update(schema_file.name.encode())
+            digest.update(schema_file.read_bytes())
+
+        return digest.hexdigest()
+
+    def _load_artifact(self):
+        artifact_file = self.cache_path / f"{self.digest}.json"
+        if not artifact_file.is_file():
+            return False
+
+        artifact = jsto(artifact_file.read_text())
+        if not isinstance(artifact, dict):
+            return False
+
+        if artifact.get("version") != ARTIFACT_VERSION:
+            return False
+
+        # Checked up front, so a truncated artifact leaves no state behind
+        for key in (*ARTIFACT_STATE, "schemas", "fields"):
+            if key not in artifact:
+                return False
+
+        for key in ARTIFACT_STATE:
+            getattr(self, key).update(artifact[key])
+
+        self.json_schemas.update(artifact["schemas"])
+        self.field_names.update(artifact["fields"])
+        return True
+
+    def _store_artifact(self):
+        artifact = dict()
+        artifact["version"] = ARTIFACT_VERSION
+        for key in ARTIFACT_STATE:
+            artifact[key] = getattr(self, key)
+
+        # Python types in the model specs are stored by name
+        artifact["model"] = deepcopy(self.model)
+        for spec in artifact["model"].values():
+            for value in spec.values():
+                value_type = value.get("type")
+                if isinstance(value_type, type):
+                    value["type"] = value_type.__name__
+
+        artifact["schemas"] = dict()
+        artifact["fields"] = dict()
+        dynamic_fields = dict()
+        for name in self.model.keys():
+            model = self.models[name]
+            artifact["schemas"][name] = jsto(model.schema_json())
+            artifact["fields"][name] = list(model.__fields__.keys())
+            dynamic_fields[name] = (model, None)
+
+        dynamic = create_model("DynamicEntry", **dynamic_fields)
+        artifact["schemas"]["_dynamic"] = jsto(dynamic.schema_json())
+
+        self.json_schemas.update(artifact["schemas"])
+        self.field_names.update(artifact["fields"])
+
+        try:
+            self.cache_path.mkdir(exist_ok=True)
+            artifact_file = self.cache_path / f"{self.digest}.json"
+            for stale_file in self.cache_path.glob("*.json"):
+                if stale_file != artifact_file:
+                    stale_file.unlink(missing_ok=True)
+
+            # Workers starting together each write their own temporary file
+            temporary_file = artifact_file.with_suffix(f".{getpid()}.tmp")
+            temporary_file.write_text(jots(artifact) or "")
+            replace(temporary_file, artifact_file)
+
+        # A read-only install still works, it just parses on every start
+        except OSError as e:
+            eprint(e)
+
+    def _signature(self):
+        signature = list()
+        for schema_file in sorted(self.path.glob("*.json")):
+            stats = schema_file.stat()
+            signature.append((schema_file.name, stats.st_mtime_ns,
+                stats.st_size))
+
+        return tuple(signature)
+
+    def reload(self):
+        self._checked = monotonic()
+        if self._signature() == self.signature:
+            return False
+
+        self.raw.clear()
+        self.model.clear()
+        self.sql.clear()
+        self.sql_meta.clear()
+        self.sql_index.clear()
+        self.sql_fts.clear()
+        self.fts.clear()
+        self.graph.clear()
+        self.compiled.clear()
+        self.json_schemas.clear()
+        self.field_names.clear()
+        self.models.clear()
+
+        self.parse()
+        return True
+
+    def refresh(self):
+        if monotonic() - self._checked >= self.check_interval:
+            return self.reload()
+
+        return False
+
+    """
+    e.g. compile("tags").validator.validate({"tag": "abc"})
+    """
+    def compile(self, name, model=None):
+        self.refresh()
+        compiled = self.compiled.get(name)
+        if compiled is not None:
+            return compiled
+
+        if model is not None:
+            schema_json = model.schema_json()
+
+        elif name in self.json_schemas:
+            schema_json = jots(self.json_schemas[name])
 
-            if name not in all_tables:
-                db.create_table(name, fields)
+        elif name in self.models:
+            schema_json = self.models[name].schema_json()
+
+        else:
+            return None
+
+        schema = jsto(schema_json)
+        validator_class = validator_for(schema)
+        validator_class.check_schema(schema)
+        validator = validator_class(schema)
+
+        compiled = CompiledSchema(schema, schema_json.encode(), validator)
+        self.compiled[name] = compiled
+        return compiled
 
     def parse(self):
+        self.signature = self._signature()
+        self.digest = self._digest()
+        if self._load_artifact():
+            return
+
+        self._parse_files()
+        self._store_artifact()
+
+    def _parse_files(self):
         sql = self._parse_sql()
         model = self._parse_model()
 
@@ -86,10 +447,11 @@ class Schemas:
 
             self.raw[schema_name] = schema_data
 
+            # The model parser rewrites its entries, keep `raw` untouched
             for key, value in schema_data.items():
                 entry = schema_name, key, value
                 sql.send(entry)
-                model.send(entry)
+                model.send((schema_name, key, deepcopy(value)))
 
         if self.debug:
             print("Graph", self.graph)
@@ -103,15 +465,20 @@ class Schemas:
                     for m_entry in meta_entries:
                         print("\t", m_entry)
 
+                for i_entry in self.sql_index[table]:
+                    print("\t", i_entry)
+
+                for f_entry in self.sql_fts[table]:
+                    print("\t", f_entry)
+
                 print()
 
     def generate_models(self):
-        schema_models = dict()
-        for name, data in self.model.items():
-            schema_model = self._schema_factory(name, data)
-            schema_models[name] = schema_model
+        # Built lazily and cleared in place, so references survive reloads
+        return self.models
 
-        return schema_models
+    def _build_model(self, name):
+        return self._schema_factory(name, deepcopy(self.model[name]))
 
     def _schema_factory(self, name, data):
         fields = dict()
@@ -180,7 +547,29 @@ class Schemas:
                         item = f"{item} ON {method.upper()} {effect.upper()}"
 
                 entry.append(item)
-                
+
+        elif key == "index" and isinstance(value, dict):
+            for index_name, parameters in value.items():
+                fields = parameters.get("fields")
+                if not isinstance(fields, list) or len(fields) == 0:
+                    continue
+
+                unique = "UNIQUE " if parameters.get("unique", False) else ""
+                ikeys = ", ".join(fields)
+                item = f"CREATE {unique}INDEX IF NOT EXISTS {index_name}"
+                item = f"{item} ON {name} ({ikeys})"
+
+                where = parameters.get("where")
+                if isinstance(where, str):
+                    item = f"{item} WHERE {where}"
+
+                self.sql_index[name].append(item)
+
+        elif key == "fts" and isinstance(value, dict):
+            fields = value.get("fields")
+            if isinstance(fields, list) and len(fields) > 0:
+                self.sql_fts[name].extend(self._fts_statements(name, value))
+
         if entry is not None:
             if isinstance(entry, list):
                 self.sql_meta[name].extend(entry)
@@ -188,6 +577,44 @@ class Schemas:
             else:
                 self.sql_meta[name].append(entry)
 
+    """
+    e.g. "_sql": {"fts": {"fields": ["title"], "tokenize": "porter"}}
+
+    An external-content FTS5 table named `<table>_fts`, kept in sync with its
+    source table by insert, delete and update triggers.
+    """
+    def _fts_statements(self, name, value):
+        fts_table = f"{name}_fts"
+        fields = value["fields"]
+        self.fts[name] = {"table": fts_table, "fields": fields}
+
+        columns = ", ".join(fields)
+        options = f"content='{name}', content_rowid='rowid'"
+        tokenize = value.get("tokenize")
+        if isinstance(tokenize, str):
+            options = f"{options}, tokenize='{tokenize}'"
+
+        new_values = ", ".join(f"new.{field}" for field in fields)
+        old_values = ", ".join(f"old.{field}" for field in fields)
+        add = f"INSERT INTO {fts_table}(rowid, {columns})"
+        add = f"{add} VALUES (new.rowid, {new_values});"
+        drop = f"INSERT INTO {fts_table}({fts_table}, rowid, {columns})"
+        drop = f"{drop} VALUES ('delete', old.rowid, {old_values});"
+
+        statements = list()
+        statements.append(f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts_table} "
+            f"USING fts5({columns}, {options})")
+
+        trigger = f"CREATE TRIGGER IF NOT EXISTS {fts_table}"
+        statements.append(f"{trigger}_insert AFTER INSERT ON {name} "
+            f"BEGIN {add} END")
+        statements.append(f"{trigger}_delete AFTER DELETE ON {name} "
+            f"BEGIN {drop} END")
+        statements.append(f"{trigger}_update AFTER UPDATE ON {name} "
+            f"BEGIN {drop} {add} END")
+
+        return statements
+
     @trap(eprint)
     @generator
     def _parse_sql(self):
@@ -1,10 +1,13 @@
 from helpers.general import eprint
 
-from os import stat, remove
+from re import compile as regex, escape
+from os import stat, remove, listdir
 from os.path import dirname, basename, isfile, isdir, join as path_join
-from shutil import copyfile
-from time import strftime
+from time import strftime, perf_counter, sleep as pause
+from random import uniform
+from datetime import date, datetime
 from operator import itemgetter
+from collections import defaultdict
 from contextlib import closing, contextmanager
 from threading import Lock
 from traceback import format_exc
@@ -12,10 +15,67 @@ from sqlite3 import connect, register_converter, PARSE_DECLTYPES, PARSE_COLNAMES
 from sqlite3 import (IntegrityError, ProgrammingError, OperationalError,
     Error as SQLiteError)
 
+try:
+    from fcntl import flock, LOCK_EX, LOCK_NB, LOCK_UN
+
+except ImportError:
+    flock = None
+
 register_converter("BOOLEAN", lambda value: bool(int(value)))
 
+# e.g. x.db.backup-20200101-100000, never the live -wal, -shm or .lock files
+BACKUP_SUFFIX = ".backup-%Y%m%d-%H%M%S"
+BACKUP_PATTERN = r"\.backup-\d{8}-\d{6}"
+
+# Write counts per table, see `track_versions`
+VERSIONS = "_versions"
+
+# SQLITE_BUSY and SQLITE_LOCKED, another connection holds the lock
+BUSY_CODES = {5, 6}
+
+"""
+Raised once a statement is still locked out after every retry, rather than
+being reported as a `False` result like other statement errors.
+"""
+class BusyError(OperationalError):
+    pass
+
+def busy(error):
+    if not isinstance(error, OperationalError):
+        return False
+
+    code = getattr(error, "sqlite_errorcode", None)
+    if code is not None:
+        return code & 0xff in BUSY_CODES
+
+    message = str(error)
+    return "database is locked" in message or "database is busy" in message
+
+# Values as SQLite stores them, so a dump reads back through the converters
+def plain(value):
+    if isinstance(value, datetime):
+        return value.isoformat(" ")
+
+    if isinstance(value, date):
+        return value.isoformat()
+
+    return value
+
+"""
+e.g. SQLite("test.db", busy_timeout=5.0, retries=5, strict=True)
+
+A connection waits up to `busy_timeout` seconds for another process's lock,
+then statements outside a transaction are retried `retries` times with a
+jittered exponential backoff starting at `backoff` seconds. With `strict`
+set, statement errors are raised instead of returned as `False`.
+
+Files in `attach` are attached as `db1`, `db2`, ... so their tables can be
+read and joined by their plain names, and the catalog covers them too.
+"""
 class SQLite:
-    def __init__(self, db_file, debug=False, lock=Lock()):
+    def __init__(self, db_file, debug=False, lock=None, readonly=False,
+        cached_statements=128, busy_timeout=5.0, retries=5, backoff=0.05,
+        strict=False, attach=None):
         self.db_file = db_file
         self.path = dirname(self.db_file)
         self.filename = basename(self.db_file)
@@ -25,82 +85,448 @@ class SQLite:
         self.connection = None
         self.cursor = None
         self.memory = False
-        self.lock = lock
+        self.readonly = readonly
+        self.busy_timeout = busy_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.strict = strict
+        # The last statement error reported as a False result
+        self.last_error = None
+        self.attached = list() if attach is None else list(attach)
+        self.schemas = ["main"]
+        self.backup_progress = None
+        self.lock = Lock() if lock is None else lock
+
+        # Statement templates, keyed by (operation, table, columns, where)
+        self.statements = dict()
+        self.cached_statements = cached_statements
+        self.tree_depth = 1024
+
+        self.tables = set()
+        self.versioned = list()
+        self.columns = dict()
+        self.schema_version = None
+
+        # Instrumentation callbacks by event, see `hook`
+        self.hooks = defaultdict(list)
+        self._began = None
         self._load()
+        self._load_catalog()
 
     def _load(self):
         settings = dict()
         settings["check_same_thread"] = False
         settings["isolation_level"] = "DEFERRED"
         settings["detect_types"] = PARSE_DECLTYPES | PARSE_COLNAMES
+        settings["cached_statements"] = self.cached_statements
+        settings["timeout"] = self.busy_timeout
         try:
-            self.connection = connect(self.db_file, **settings)
-            self.connection.execute("PRAGMA journal_mode = WAL")
+            if self.readonly:
+                uri = f"file:{self.db_file}?mode=ro"
+                self.connection = connect(uri, uri=True, **settings)
+                self.connection.execute("PRAGMA query_only = ON")
+
+            else:
+                self.connection = connect(self.db_file, **settings)
+                self.connection.execute("PRAGMA journal_mode = WAL")
+
             self.connection.execute("PRAGMA foreign_keys = ON")
+            for index, attach_file in enumerate(self.attached):
+                self._attach(f"db{index + 1}", attach_file)
+
         except SQLiteError as e:
             eprint(format_exc() if self.debug else str(e))
             self.connection = connect(":memory:")
+            self.schemas = ["main"]
             self.memory = True
         # self.cursor = self.connection.cursor()
 
+    def _attach(self, schema, attach_file):
+        if self.readonly:
+            attach_file = f"file:{attach_file}?mode=ro"
+
+        self.connection.execute(f"ATTACH DATABASE ? AS {schema}",
+            (attach_file,))
+        self.schemas.append(schema)
+
+    def _load_catalog(self):
+        tables = list()
+        versioned = list()
+        for schema in self.schemas:
+            executor = f"SELECT name, sql FROM {schema}.sqlite_master "
+            executor = f"{executor}WHERE type='table'"
+            schema_tables = self.fetch(executor)
+            if schema_tables is False:
+                return
+
+            for name, sql in schema_tables:
+                if name == VERSIONS:
+                    versioned.append(schema)
+
+                else:
+                    tables.append((name, sql))
+
+        # Virtual tables, e.g. FTS5 indexes, and their shadow tables are
+        # internals of the tables they index
+        virtual = [f"{name}_" for name, sql in tables
+            if (sql or "").upper().startswith("CREATE VIRTUAL TABLE")]
+
+        self.schema_version = self._schema_version()
+        self.versioned = versioned
+        self.tables = set(name for name, _ in tables
+            if not f"{name}_".startswith(tuple(virtual)))
+        self.columns = dict()
+        for table in self.tables:
+            self._load_columns(table)
+
+    def _load_columns(self, table):
+        info = self.fetch(f"PRAGMA table_info({table})")
+        if info is False or len(info) == 0:
+            self.columns.pop(table, None)
+            return
+
+        # cid, name, type, notnull, dflt_value, pk
+        self.columns[table] = {column[1]: column[2] for column in info}
+
+    def _schema_version(self):
+        versions = list()
+        for schema in self.schemas:
+            version = self.fetch(f"PRAGMA {schema}.schema_version")
+            versions.append(version[0][0] if version else None)
+
+        return tuple(versions)
+
+    """
+    e.g. track_versions("notes")
+
+    Counts the rows written to `table` in the `_versions` table. Triggers do
+    the counting, inside the transaction that wrote the rows, so writes from
+    every connection and process are counted, cascades included.
+    """
+    def track_versions(self, table):
+        executor = f"CREATE TABLE IF NOT EXISTS {VERSIONS} (name TEXT "
+        executor = f"{executor}PRIMARY KEY, version INTEGER NOT NULL) "
+        self.execute(f"{executor}WITHOUT ROWID")
+
+        executor = f"INSERT OR IGNORE INTO {VERSIONS} (name, version) "
+        self.execute(f"{executor}VALUES (?, 0)", (table,), commit=True)
+
+        bump = f"UPDATE {VERSIONS} SET version = version + 1"
+        bump = f"{bump} WHERE name = '{table}';"
+        for event in ("insert", "update", "delete"):
+            trigger = f"CREATE TRIGGER IF NOT EXISTS {table}_version_{event}"
+            self.execute(f"{trigger} AFTER {event.upper()} ON {table} "
+                f"BEGIN {bump} END")
+
+    """
+    e.g. versions(["notes", "tags"]) -> (12, 40, 7)
+
+    The schema version of every attached file, then the write counts of
+    `tables`, so the result changes whenever one of those tables or the
+    schema does, and only then.
+    """
+    def versions(self, tables):
+        self._check_catalog()
+        counts = dict()
+        places = ",".join(["?"] * len(tables))
+        for schema in self.versioned if len(tables) > 0 else tuple():
+            executor = f"SELECT name, version FROM {schema}.{VERSIONS}"
+            executor = f"{executor} WHERE name IN ({places})"
+            rows = self.fetch(executor, tuple(tables)) or tuple()
+            for name, version in rows:
+                counts[name] = counts.get(name, 0) + version
+
+        return (*self.schema_version, *(counts.get(table) for table in tables))
+
+    def _check_catalog(self):
+        if self._schema_version() != self.schema_version:
+            self._load_catalog()
+
+    """
+    e.g.
+        with db.init_lock():
+            schemas.create_tables(db)
+
+    Serializes one-time setup across worker processes with an advisory lock
+    on a file next to the database. The catalog is reloaded once the lock is
+    held, so a worker that waited sees the tables the first one created.
+    """
+    @contextmanager
+    def init_lock(self):
+        if self.memory or flock is None:
+            yield
+            return
+
+        with open(f"{self.db_file}.lock", "a") as lock_file:
+            flock(lock_file.fileno(), LOCK_EX)
+            try:
+                self._check_catalog()
+                yield
+
+            finally:
+                flock(lock_file.fileno(), LOCK_UN)
+
+    """
+    e.g.
+        with db.claim_lock("backup") as claimed:
+            ...
+
+    Like `init_lock` but gives up at once when another process holds the
+    lock, so only one of many workers takes on a job. Without flock every
+    process claims it.
+    """
+    @contextmanager
+    def claim_lock(self, name):
+        if self.memory or flock is None:
+            yield True
+            return
+
+        with open(f"{self.db_file}.{name}.lock", "a") as lock_file:
+            try:
+                flock(lock_file.fileno(), LOCK_EX | LOCK_NB)
+
+            except OSError:
+                yield False
+                return
+
+            try:
+                yield True
+
+            finally:
+                flock(lock_file.fileno(), LOCK_UN)
+
+    """
+    e.g.
+        hook("statement", lambda executor, seconds, rows, error: ...)
+        hook("lock", lambda seconds: ...)
+        hook("transaction", lambda seconds, committed: ...)
+
+    Callbacks run on the thread that used the connection, after each
+    statement, after `self.lock` is acquired with the time spent waiting,
+    and when a transaction ends with the time the lock was held.
+    """
+    def hook(self, event, callback):
+        self.hooks[event].append(callback)
+
+    def _emit(self, event, *args):
+        for callback in self.hooks.get(event, tuple()):
+            callback(*args)
+
+    def _observe(self, executor, started, rows, error=None):
+        if len(self.hooks.get("statement", tuple())) > 0:
+            self._emit("statement", executor, perf_counter() - started,
+                rows, error)
+
+    def _acquire(self):
+        started = perf_counter()
+        self.lock.acquire()
+        acquired = perf_counter()
+        self._emit("lock", acquired - started)
+        return acquired
+
     def _unload(self):
         self.connection.close()
 
     # Must be called from `backup`
     def _remove_old_backups(self, backup_dir, backups):
-        contents = listdir(backup_dir)
+        pattern = regex(f"{escape(self.filename)}{BACKUP_PATTERN}")
+        contents = [path_join(backup_dir, f) for f in listdir(backup_dir)
+            if pattern.fullmatch(f)]
         files = [(f, stat(f).st_mtime) for f in contents if isfile(f)]
         # Sort by mtime
         files.sort(key=itemgetter(1))
-        remove_files = files[:-backups]
-        for rfile in remove_files:
+        remove_files = files[:-backups] if backups > 0 else files
+        for rfile, _ in remove_files:
             remove(rfile)
 
-    def _convert(self, values):
-        convert = lambda value: value if not None else "NULL"
-        return (convert(value) for value in values)
+    """
+    e.g. _statement(("insert", "test", ("value",)))
+         -> "INSERT INTO test (value) VALUES(?)"
+
+    Templates are built once per distinct shape, so a hot call only has to
+    bind its parameters.
+    """
+    def _statement(self, key):
+        executor = self.statements.get(key)
+        if executor is not None:
+            return executor
+
+        # Free-form where clauses could grow this without bound
+        if len(self.statements) >= self.cached_statements:
+            self.statements.clear()
+
+        operation, *shape = key
+        builder = getattr(self, f"_build_{operation}")
+        executor = builder(*shape)
+        self.statements[key] = executor
+        return executor
+
+    def _build_insert(self, table, columns):
+        keys = ",".join(columns)
+        places = ",".join(["?"] * len(columns))
+        return f"INSERT INTO {table} ({keys}) VALUES({places})"
+
+    def _build_insert_id(self, table, columns):
+        return f"{self._build_insert(table, columns)} RETURNING rowid"
+
+    def _build_upsert(self, table, columns, keys, update):
+        executor = self._build_insert(table, columns)
+        executor = f"{executor} ON CONFLICT ({','.join(keys)})"
+        if len(update) == 0:
+            return f"{executor} DO NOTHING RETURNING rowid"
+
+        sets = ",".join(f"{column} = excluded.{column}" for column in update)
+        return f"{executor} DO UPDATE SET {sets} RETURNING rowid"
+
+    def _build_ensure(self, table, columns, keys, count):
+        keys_string = ",".join(keys)
+        row = "(" + ",".join(["?"] * len(columns)) + ")"
+        executor = f"INSERT INTO {table} ({','.join(columns)})"
+        executor = f"{executor} VALUES {','.join([row] * count)}"
+        executor = f"{executor} ON CONFLICT ({keys_string}) DO NOTHING"
+        return f"{executor} RETURNING rowid, {keys_string}"
+
+    def _build_existing(self, table, keys, count):
+        keys_string = ",".join(keys)
+        row = "(" + ",".join(["?"] * len(keys)) + ")"
+        rows = ",".join([row] * count)
+        executor = f"SELECT rowid, {keys_string} FROM {table}"
+        return f"{executor} WHERE ({keys_string}) IN (VALUES {rows})"
+
+    def _build_update(self, table, columns, where_query):
+        assert isinstance(where_query, str), "Expected str"
+        keys = ",".join(f"{key} = ?" for key in columns)
+        return f"UPDATE {table} SET {keys} WHERE {where_query}"
+
+    def _build_delete(self, table, where_query):
+        assert isinstance(where_query, str), "Expected str"
+        return f"DELETE FROM {table} WHERE {where_query}"
+
+    def _build_lookup(self, table, search, where_query, order):
+        keys = ",".join(search)
+        executor = f"SELECT {keys} FROM {table}"
+        if where_query is not None:
+            assert isinstance(where_query, str), "Expected str"
+            executor = f"{executor} WHERE {where_query}"
+
+        if order is not None:
+            executor = f"{executor} ORDER BY rowid {order} LIMIT ?"
+
+        return executor
 
     def stop(self):
         self._unload()
 
-    def backup(self, backup_dir=None, backups=1):
+    """
+    e.g. backup("/var/backups", backups=3, progress=print)
+
+    Online copy through the sqlite3 backup API, `pages` at a time with a
+    `sleep` between steps so writers keep going. The source is this
+    connection, so its own writes land in the copy instead of restarting it.
+    """
+    def backup(self, backup_dir=None, backups=1, pages=256, sleep=0.05,
+        progress=None):
         if backup_dir is None:
-            backup_dir = self.path
+            backup_dir = self.path or "."
 
         if not isdir(backup_dir):
             eprint("ERROR: Backup directory does not exist")
             return None
 
-        suffix = strftime("-%Y%m%d-%H%M%S")
-        backup_name = f"{self.filename} {suffix}"
+        suffix = strftime(BACKUP_SUFFIX)
+        backup_name = f"{self.filename}{suffix}"
         backup_file = path_join(backup_dir, backup_name)
-        # Lock database
-        with closing(self.connection.cursor()) as cursor:
-            cursor.execute("begin immediate")
-            copyfile(self.db_file, backup_file)
-        # Unlock database
-        self.conenction.rollback()
+
+        self.backup_progress = dict()
+        self.backup_progress["file"] = backup_file
+        self.backup_progress["status"] = "running"
+        self.backup_progress["remaining"] = None
+        self.backup_progress["total"] = None
+
+        def step(status, remaining, total):
+            self.backup_progress["remaining"] = remaining
+            self.backup_progress["total"] = total
+            if progress is not None:
+                progress(status, remaining, total)
+
+        try:
+            with closing(connect(backup_file)) as target:
+                self.connection.backup(target, pages=pages, progress=step,
+                    sleep=sleep)
+
+        except SQLiteError as e:
+            eprint(format_exc() if self.debug else str(e))
+            self.backup_progress["status"] = "error"
+            self.backup_progress["error"] = str(e)
+            if isfile(backup_file):
+                remove(backup_file)
+
+            return None
+
+        self.backup_progress["status"] = "done"
         self._remove_old_backups(backup_dir, backups)
+        return backup_file
 
     def execute(self, executor, values=tuple(), fetch=False, commit=False):
+        # Inside a caller's transaction only the whole transaction can retry
+        held = self.connection.in_transaction or self.lock.locked()
+        retry = commit or not held
+        attempt = 0
+        while True:
+            try:
+                return self._execute(executor, values, fetch, commit)
+
+            except OperationalError as e:
+                if not busy(e):
+                    return self._failed(e)
+
+                if not retry or attempt >= self.retries:
+                    raise BusyError(str(e)) from e
+
+                if self.connection.in_transaction:
+                    self.connection.rollback()
+
+                pause(self.backoff * 2 ** attempt * uniform(0.5, 1.5))
+                attempt = attempt + 1
+
+            except (ProgrammingError, IntegrityError) as e:
+                return self._failed(e)
+
+    def _execute(self, executor, values, fetch, commit):
+        started = perf_counter()
+        rows = 0
+        error = None
         try:
             with closing(self.connection.cursor()) as cursor:
-                args = (executor, values) if "?" in executor else (executor,)
                 if commit:
                     with self.transaction():
-                        result = cursor.execute(*args)
+                        result = cursor.execute(executor, values)
 
                 else:
-                    result = cursor.execute(*args)
+                    result = cursor.execute(executor, values)
 
                 if not fetch:
+                    rows = max(cursor.rowcount, 0)
                     return True
 
-                return cursor.fetchall()
+                result = cursor.fetchall()
+                rows = len(result)
+                return result
 
-        except (ProgrammingError, IntegrityError, OperationalError) as e:
-            eprint(format_exc() if self.debug else str(e))
-            return False
+        except SQLiteError as e:
+            error = e
+            raise
+
+        finally:
+            self._observe(executor, started, rows, error)
+
+    def _failed(self, error):
+        if self.strict:
+            raise error
+
+        self.last_error = error
+        eprint(format_exc() if self.debug else str(error))
+        return False
 
     def fetch(self, executor, values=tuple(), commit=False):
         return self.execute(executor, values, fetch=True, commit=commit)
@@ -121,94 +547,299 @@ class SQLite:
 
         fields_string = ",".join(fields)
         executor = f"CREATE TABLE {name} ({fields_string})"
-        return self.execute(executor, commit=commit)
+        created = self.execute(executor, commit=commit)
+        if created:
+            self.tables.add(name)
+            self._load_columns(name)
+            self.schema_version = self._schema_version()
+
+        return created
 
     """
     e.g. insert("test", {"value": "abc"})
     """
     def insert(self, table, insertion, commit=False):
-        assert isinstance(insertion, dict), "Expected dict"
-        keys = ",".join(insertion.keys())
-        places = ",".join(["?"] * len(insertion))
-        values = tuple(self._convert(insertion.values()))
-        executor = f"INSERT INTO {table} ({keys}) VALUES({places})"
-        return self.execute(executor, values, commit=commit)
+        executor = self._statement(("insert", table, tuple(insertion)))
+        return self.execute(executor, tuple(insertion.values()), commit=commit)
+
+    """
+    e.g. insert_id("test", {"value": "abc"}) -> 1
+
+    Like `insert`, but returns the new row's id, or None when it failed.
+    """
+    def insert_id(self, table, insertion):
+        executor = self._statement(("insert_id", table, tuple(insertion)))
+        result = self.fetch(executor, tuple(insertion.values()))
+        if not result:
+            return None
+
+        return result[0][0]
+
+    """
+    e.g. upsert("tags", {"tag": "sql"}, ["tag"]) -> 1
+
+    Inserts the row or, when it conflicts with an existing one on `keys`,
+    updates that row's `update` columns instead, by default every other
+    column given. Returns the row's id either way, None when it failed.
+    """
+    def upsert(self, table, insertion, keys, update=None):
+        if update is None:
+            update = [column for column in insertion if column not in keys]
+
+        key = "upsert", table, tuple(insertion), tuple(keys), tuple(update)
+        result = self.fetch(self._statement(key), tuple(insertion.values()))
+        if result is False:
+            return None
+
+        if len(result) > 0:
+            return result[0][0]
+
+        # DO NOTHING returns no row for an existing one, so look it up
+        existing = self._existing(table, keys, [tuple(insertion[key]
+            for key in keys)])
+        if existing is None:
+            return None
+
+        return existing.get(tuple(insertion[key] for key in keys))
+
+    """
+    e.g. ensure_many("tags", [{"tag": "sql"}, {"tag": "new"}], ["tag"])
+         -> [1, 2]
+
+    Ids for every row, in order, inserting the rows whose `keys` are not
+    there yet and leaving existing ones as they are. Each chunk is one
+    multi-row INSERT ... DO NOTHING and one SELECT for the rows that already
+    existed, instead of a lookup and an insert per row. Rows must all have
+    the same columns, None when they do not or a statement failed.
+    """
+    def ensure_many(self, table, insertions, keys, chunk_size=500):
+        if len(insertions) == 0:
+            return list()
+
+        columns = tuple(insertions[0])
+        if any(tuple(insertion) != columns for insertion in insertions):
+            return None
+
+        ids = dict()
+        for start in range(0, len(insertions), chunk_size):
+            chunk = dict()
+            for insertion in insertions[start:start + chunk_size]:
+                chunk.setdefault(tuple(insertion[key] for key in keys),
+                    tuple(insertion.values()))
+
+            key = "ensure", table, columns, tuple(keys), len(chunk)
+            values = tuple(value for row in chunk.values() for value in row)
+            inserted = self.fetch(self._statement(key), values)
+            if inserted is False:
+                return None
+
+            for row_id, *row_keys in inserted:
+                ids[tuple(row_keys)] = row_id
+
+            missing = [row_keys for row_keys in chunk if row_keys not in ids]
+            existing = self._existing(table, keys, missing)
+            if existing is None:
+                return None
+
+            ids.update(existing)
+
+        return [ids.get(tuple(insertion[key] for key in keys))
+            for insertion in insertions]
+
+    def _existing(self, table, keys, rows):
+        if len(rows) == 0:
+            return dict()
+
+        key = "existing", table, tuple(keys), len(rows)
+        values = tuple(value for row in rows for value in row)
+        found = self.fetch(self._statement(key), values)
+        if found is False:
+            return None
+
+        return {tuple(row_keys): row_id for row_id, *row_keys in found}
+
+    """
+    e.g. insert_many("test", [{"value": "abc"}, {"value": "xyz"}])
+         -> [{"id": 1}, {"id": 2}]
+
+    Rows are grouped by column set and written with `executemany`, falling
+    back to row-by-row savepoints for a group that fails so the error can be
+    pinned to its row. Must be called inside `transaction`.
+    """
+    def insert_many(self, table, insertions, chunk_size=500):
+        results = [None] * len(insertions)
+        groups = defaultdict(list)
+        for index, insertion in enumerate(insertions):
+            if not isinstance(insertion, dict):
+                results[index] = {"error": "Expected dict"}
+                continue
+
+            groups[tuple(insertion.keys())].append(index)
+
+        if not self.connection.in_transaction:
+            self._immediate()
+
+        for columns, indices in groups.items():
+            executor = self._statement(("insert", table, columns))
+            for start in range(0, len(indices), chunk_size):
+                chunk = indices[start:start + chunk_size]
+                rows = [tuple(insertions[i].values()) for i in chunk]
+                ids = self._insert_chunk(executor, columns, rows)
+                if ids is None:
+                    ids = self._insert_rows(executor, rows)
+
+                for index, row_id in zip(chunk, ids):
+                    results[index] = row_id
+
+        return results
+
+    def _insert_chunk(self, executor, columns, rows):
+        explicit = None
+        if "id" in columns:
+            position = columns.index("id")
+            explicit = [row[position] for row in rows]
+            # Without every id given the assigned ones cannot be inferred
+            if None in explicit:
+                return None
+
+        with closing(self.connection.cursor()) as cursor:
+            cursor.execute("SAVEPOINT insert_chunk")
+            try:
+                cursor.executemany(executor, rows)
+
+            except SQLiteError as e:
+                cursor.execute("ROLLBACK TO insert_chunk")
+                cursor.execute("RELEASE insert_chunk")
+                if busy(e):
+                    raise BusyError(str(e)) from e
+
+                return None
+
+            cursor.execute("SELECT last_insert_rowid()")
+            last_id = cursor.fetchone()[0]
+            cursor.execute("RELEASE insert_chunk")
+
+        if explicit is None:
+            # Within one writer transaction new rowids are handed out in order
+            explicit = range(last_id - len(rows) + 1, last_id + 1)
+
+        return [{"id": row_id} for row_id in explicit]
+
+    def _insert_rows(self, executor, rows):
+        ids = list()
+        with closing(self.connection.cursor()) as cursor:
+            for row in rows:
+                cursor.execute("SAVEPOINT insert_row")
+                try:
+                    cursor.execute(executor, row)
+                    ids.append({"id": cursor.lastrowid})
+
+                except SQLiteError as e:
+                    cursor.execute("ROLLBACK TO insert_row")
+                    if busy(e):
+                        cursor.execute("RELEASE insert_row")
+                        raise BusyError(str(e)) from e
+
+                    ids.append({"error": str(e)})
+
+                cursor.execute("RELEASE insert_row")
+
+        return ids
 
     """
     e.g. delete("test", {"value": "xyz"}, ("id = ?", (1,)))
     """
     def update(self, table, modification, where, commit=False):
-        assert isinstance(modification, dict), "Expected dict"
-        assert isinstance(where, tuple), "Expected tuple"
-        assert len(where) == 2, "Expected length of '2'"
-        assert isinstance(where[0], str), "Expected str"
-        assert isinstance(where[1], tuple), "Expected tuple"
-        keys = ",".join(f"{key} = ?" for key in modification.keys())
-        mod_values = tuple(self._convert(modification.values()))
-        where_query = where[0]
-        where_values = where[1]
-        values = mod_values + where_values
-        executor = f"UPDATE {table} SET {keys} WHERE {where_query}"
+        where_query, where_values = where
+        key = "update", table, tuple(modification), where_query
+        executor = self._statement(key)
+        values = (*modification.values(), *where_values)
         return self.execute(executor, values, commit=commit)
 
     """
     e.g. delete("test", ("id = ?", (1,)))
     """
     def delete(self, table, where, commit=False):
-        assert isinstance(where, tuple), "Expected tuple"
-        assert len(where) == 2, "Expected length of '2'"
-        assert isinstance(where[0], str), "Expected str"
-        assert isinstance(where[1], tuple), "Expected tuple"
-        where_query = where[0]
-        where_values = where[1]
-        values = where_values
-        executor = f"DELETE FROM {table} WHERE {where_query}"
-        return self.execute(executor, values, commit=commit)
+        where_query, where_values = where
+        executor = self._statement(("delete", table, where_query))
+        return self.execute(executor, where_values, commit=commit)
 
-    def lookup(self, table, search, where=None, limit= None):
+    """
+    e.g. iter_lookup("test", ["id", "value"], ("value = ?", ("abc",)))
+         -> {"id": 1, "value": "abc"}, ...
+
+    Rows are pulled in `fetchmany` batches and the cursor is only held open
+    while the generator is being consumed. A "*" search maps every column.
+    """
+    def iter_lookup(self, table, search, where=None, limit=None,
+        batch_size=256):
         if type(search) != list:
             search = [search]
 
-        keys = ",".join(search)
-        executor = f"SELECT {keys} FROM {table}"
+        where_query = None
+        values = tuple()
         if where is not None:
-            assert isinstance(where, tuple), "Expected tuple"
-            assert len(where) == 2, "Expected length of '2'"
-            assert isinstance(where[0], str), "Expected str"
-            assert isinstance(where[1], tuple), "Expected tuple"
-            where_query = where[0]
-            where_values = where[1]
-            executor = f"{executor} WHERE {where_query}"
-            if limit is not None:
-                asc = True
-                if limit < 0:
-                    limit = -limit
-                    asc = False
+            where_query, values = where
 
-                asc_desc = "ASC" if asc else "DESC"
-                executor = f"{executor} ORDER BY id {asc_desc} LIMIT {limit}"
+        order = None
+        if limit is not None:
+            order = "ASC" if limit >= 0 else "DESC"
+            values = (*values, abs(limit))
 
-            results = self.fetch(executor, where_values)
+        key = "lookup", table, tuple(search), where_query, order
+        executor = self._statement(key)
 
-        else:
-            results = self.fetch(executor)
+        with closing(self.connection.cursor()) as cursor:
+            started = perf_counter()
+            try:
+                cursor.execute(executor, values)
 
-        found = list()
-        if results is False:
-            return found
+            except (ProgrammingError, IntegrityError, OperationalError) as e:
+                self._observe(executor, started, 0, e)
+                self._stream_failed(e)
+                return
 
-        for result in results:
-            remap = dict()
-            for index, term in enumerate(search):
-                if term == "*":
-                    remap[term] = result
+            terms = tuple(search)
+            if "*" in terms:
+                terms = tuple(column[0] for column in cursor.description)
 
-                else:
-                    remap[term] = result[index]
+            for row in self._fetch_batches(cursor, batch_size, executor,
+                started):
+                yield dict(zip(terms, row))
+
+    # Timed until exhausted, so a slow consumer shows up as a slow statement
+    def _fetch_batches(self, cursor, batch_size, executor, started):
+        count = 0
+        error = None
+        try:
+            while True:
+                try:
+                    rows = cursor.fetchmany(batch_size)
+
+                except (ProgrammingError, IntegrityError,
+                    OperationalError) as e:
+                    error = e
+                    self._stream_failed(e)
+                    break
 
-            found.append(remap)
+                if len(rows) == 0:
+                    break
 
-        return found
+                count = count + len(rows)
+                yield from rows
+
+        finally:
+            self._observe(executor, started, count, error)
+
+    # Generators cannot return False, so a failure ends them early instead
+    def _stream_failed(self, error):
+        if isinstance(error, OperationalError) and busy(error):
+            raise BusyError(str(error)) from error
+
+        self._failed(error)
+
+    def lookup(self, table, search, where=None, limit=None):
+        return list(self.iter_lookup(table, search, where, limit))
 
     def lookup_one(self, table, search, where=None):
         result = self.lookup(table, search, where)
@@ -217,21 +848,285 @@ class SQLite:
     def lookup_all(self, table, where=None, limit=None):
         return self.lookup(table, ["*"], where, limit)
 
+    """
+    e.g. scan("test", ["id", "value"], after=100, limit=50)
+         -> (101, {"id": 101, "value": "abc"}), ...
+
+    Keyset scan ordered by rowid, pulling rows in `fetchmany` batches so the
+    full result is never materialized.
+    """
+    def scan(self, table, search, where=None, after=None, limit=None,
+        batch_size=256):
+        keys = ",".join(search)
+        clauses = list()
+        values = tuple()
+        if where is not None:
+            clauses.append(f"({where[0]})")
+            values = values + tuple(where[1])
+
+        if after is not None:
+            clauses.append("rowid > ?")
+            values = values + (after,)
+
+        executor = f"SELECT rowid, {keys} FROM {table}"
+        if len(clauses) > 0:
+            executor = f"{executor} WHERE {' AND '.join(clauses)}"
+
+        # SQLite reads a negative LIMIT as no limit at all
+        executor = f"{executor} ORDER BY rowid"
+        if limit is not None:
+            executor = f"{executor} LIMIT ?"
+            values = values + (max(limit, 0),)
+
+        with closing(self.connection.cursor()) as cursor:
+            started = perf_counter()
+            try:
+                cursor.execute(executor, values)
+
+            except (ProgrammingError, IntegrityError, OperationalError) as e:
+                self._observe(executor, started, 0, e)
+                self._stream_failed(e)
+                return
+
+            terms = tuple(search)
+            for row in self._fetch_batches(cursor, batch_size, executor,
+                started):
+                yield row[0], dict(zip(terms, row[1:]))
+
+    """
+    e.g. page("test", ["id", "value"], limit=50) -> ([...], 50)
+
+    Returns the entries and the rowid to continue after, or None when the
+    scan is exhausted.
+    """
+    def page(self, table, search, where=None, after=None, limit=None):
+        entries = list()
+        last = None
+        for last, entry in self.scan(table, search, where, after, limit):
+            entries.append(entry)
+
+        if limit is None or len(entries) < limit:
+            last = None
+
+        return entries, last
+
+    """
+    e.g. iter_tree("data", 1, ["id", "raw_data"], depth=2)
+         -> {"id": 1, "raw_data": "...", "depth": 0}, ...
+
+    Walks a self-referencing table in one WITH RECURSIVE query, either down
+    to the descendants of `root` or up to its ancestors, breadth first.
+    """
+    def iter_tree(self, table, root, search, parent="parent_id",
+        direction="descendants", depth=None, batch_size=256):
+        if direction == "ancestors":
+            join = f"t.rowid = tree.{parent}"
+
+        else:
+            join = f"t.{parent} = tree.node"
+
+        keys = ",".join(f"t.{key}" for key in search)
+        executor = (f"WITH RECURSIVE tree(node, {parent}, depth) AS ("
+            f"SELECT rowid, {parent}, 0 FROM {table} WHERE rowid = ? "
+            f"UNION ALL SELECT t.rowid, t.{parent}, tree.depth + 1 "
+            f"FROM {table} t JOIN tree ON {join} WHERE tree.depth < ?) "
+            f"SELECT {keys}, tree.depth FROM tree "
+            f"JOIN {table} t ON t.rowid = tree.node "
+            f"ORDER BY tree.depth, tree.node")
+
+        # A cycle in the parent links would otherwise recurse forever
+        if depth is None or depth < 0 or depth > self.tree_depth:
+            depth = self.tree_depth
+
+        with closing(self.connection.cursor()) as cursor:
+            started = perf_counter()
+            try:
+                cursor.execute(executor, (root, depth))
+
+            except (ProgrammingError, IntegrityError, OperationalError) as e:
+                self._observe(executor, started, 0, e)
+                self._stream_failed(e)
+                return
+
+            terms = (*search, "depth")
+            for row in self._fetch_batches(cursor, batch_size, executor,
+                started):
+                yield dict(zip(terms, row))
+
+    def tree(self, table, root, search, parent="parent_id",
+        direction="descendants", depth=None):
+        return list(self.iter_tree(table, root, search, parent, direction,
+            depth))
+
+    """
+    e.g. search("notes", "notes_fts", ["id", "title"], "sqlite", limit=10)
+         -> [{"id": 1, "title": "...", "snippet": "...", "rank": -1.2}]
+
+    Ranked full-text search against an external-content FTS5 table.
+    """
+    def search(self, table, fts_table, search, query, limit=20, offset=0):
+        keys = ",".join(f"t.{key}" for key in search)
+        snippet = f"snippet({fts_table}, -1, '[', ']', '...', 16)"
+        executor = (f"SELECT {keys}, {snippet}, bm25({fts_table}) AS rank "
+            f"FROM {fts_table} JOIN {table} t ON t.rowid = {fts_table}.rowid "
+            f"WHERE {fts_table} MATCH ? ORDER BY rank LIMIT ? OFFSET ?")
+
+        results = self.fetch(executor, (query, limit, offset))
+        if results is False:
+            return None
+
+        terms = (*search, "snippet", "rank")
+        return [dict(zip(terms, result)) for result in results]
+
+    """
+    e.g. explain("test", ["id"], ("value = ?", ("abc",)))
+         -> [{"id": 2, "parent": 0, "detail": "SEARCH test USING INDEX ..."}]
+    """
+    def explain(self, table, search, where=None):
+        if type(search) != list:
+            search = [search]
+
+        keys = ",".join(search)
+        executor = f"EXPLAIN QUERY PLAN SELECT {keys} FROM {table}"
+        values = tuple()
+        if where is not None:
+            executor = f"{executor} WHERE {where[0]}"
+            values = tuple(where[1])
+
+        plan = self.fetch(executor, values)
+        if plan is False:
+            return None
+
+        # id, parent, notused, detail
+        return [{"id": p[0], "parent": p[1], "detail": p[3]} for p in plan]
+
     def get_all_tables(self):
-        executor = "SELECT name FROM sqlite_master WHERE type='table'"
-        tables = self.fetch(executor)
-        return (table[0] for table in tables)
+        self._check_catalog()
+        return sorted(self.tables)
+
+    def has_table(self, name):
+        if name in self.tables:
+            return True
+
+        # Only a miss pays for a catalog check, to notice external changes
+        self._check_catalog()
+        return name in self.tables
 
     def drop_table(self, name, commit=False):
         executor = f"DROP TABLE IF EXISTS {name}"
-        return self.execute(executor, commit=commit)
+        dropped = self.execute(executor, commit=commit)
+        if dropped:
+            self.tables.discard(name)
+            self.columns.pop(name, None)
+            self.schema_version = self._schema_version()
 
-    @contextmanager
-    def transaction(self):
-        with self.lock:
+        return dropped
+
+    """
+    e.g. export(["tags", "notes"])
+         -> {"table": "tags", "columns": ["id", "tag"]},
+            {"table": "tags", "rows": [[1, "abc"], ...]}, ...
+
+    Every table is read inside one read transaction, so the dump is a
+    consistent snapshot even while writers carry on.
+    """
+    def export(self, tables, batch_size=1000):
+        self._check_catalog()
+        with closing(self.connection.cursor()) as cursor:
+            cursor.execute("BEGIN")
             try:
-                yield
+                for table in tables:
+                    columns = list(self.columns.get(table, dict()))
+                    if len(columns) == 0:
+                        continue
+
+                    yield {"table": table, "columns": columns}
+
+                    keys = ",".join(columns)
+                    executor = f"SELECT {keys} FROM {table} ORDER BY rowid"
+                    cursor.execute(executor)
+                    while True:
+                        rows = cursor.fetchmany(batch_size)
+                        if len(rows) == 0:
+                            break
+
+                        rows = [[plain(item) for item in row] for row in rows]
+                        yield {"table": table, "rows": rows}
+
+            finally:
+                self.connection.rollback()
+
+    """
+    e.g. import_rows("tags", ["id", "tag"], [(1, "abc"), (2, "xyz")])
+
+    Must be called between `begin` and `end`, errors are left to abort the
+    whole import.
+    """
+    def import_rows(self, table, columns, rows):
+        executor = self._statement(("insert", table, tuple(columns)))
+        with closing(self.connection.cursor()) as cursor:
+            cursor.executemany(executor, rows)
+
+        return len(rows)
+
+    # Taking the write lock up front lets busy_timeout wait for it
+    def _immediate(self):
+        try:
+            self.connection.execute("BEGIN IMMEDIATE")
+
+        except OperationalError as e:
+            if busy(e):
+                raise BusyError(str(e)) from e
+
+            raise
+
+    """
+    e.g. begin(defer_foreign_keys=True); ...; end(commit=True)
+
+    A transaction spanning several calls, holding the lock until `end`.
+    """
+    def begin(self, defer_foreign_keys=False):
+        self._began = self._acquire()
+        try:
+            self._immediate()
+            if defer_foreign_keys:
+                self.connection.execute("PRAGMA defer_foreign_keys = ON")
+
+        except:
+            self.lock.release()
+            raise
+
+    def end(self, commit=True):
+        committed = False
+        try:
+            if commit:
                 self.connection.commit()
-            except:
+                committed = True
+
+            else:
                 self.connection.rollback()
-                raise
+
+        except:
+            self.connection.rollback()
+            raise
+
+        finally:
+            self.lock.release()
+            self._emit("transaction", perf_counter() - self._began, committed)
+
+    @contextmanager
+    def transaction(self):
+        started = self._acquire()
+        committed = False
+        try:
+            yield
+            self.connection.commit()
+            committed = True
+
+        except:
+            self.connection.rollback()
+            raise
+
+        finally:
+            self.lock.release()
+            self._emit("transaction", perf_counter() - started, committed)
@@ -0,0 +1,269 @@
+from database.sqlite import SQLite
+
+from re import compile as regex
+
+"""
+Boolean tag expressions over tagmap, e.g. `python AND (sqlite OR fts) NOT
+draft`. Adjacent terms are implicitly AND-ed, and quoted tags may contain
+spaces or operator words.
+
+e.g.
+    parse_tags("a b NOT c") -> ("and", [("tag", "a"), ("tag", "b"),
+        ("not", ("tag", "c"))])
+"""
+
+TOKENS = regex(r'\s*(?:(\()|(\))|"((?:[^"]|"")*)"|([^\s()"]+))')
+OPERATORS = {"AND", "OR", "NOT"}
+TABLES = ("notes", "tags", "tagmap")
+
+class TagSyntaxError(ValueError):
+    pass
+
+def _tokenize(expression):
+    tokens = list()
+    position = 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = TOKENS.match(expression, position)
+        if match is None or match.end() == position:
+            raise TagSyntaxError(f"Unexpected input at {position}")
+
+        position = match.end()
+        opened, closed, quoted, word = match.groups()
+        if opened is not None:
+            tokens.append(("(", None))
+
+        elif closed is not None:
+            tokens.append((")", None))
+
+        elif quoted is not None:
+            tokens.append(("tag", quoted.replace('""', '"')))
+
+        elif word.upper() in OPERATORS:
+            tokens.append((word.upper(), None))
+
+        else:
+            tokens.append(("tag", word))
+
+    return tokens
+
+def parse_tags(expression):
+    tokens = _tokenize(expression)
+    if len(tokens) == 0:
+        raise TagSyntaxError("Empty tag expression")
+
+    node, position = _parse_or(tokens, 0)
+    if position != len(tokens):
+        raise TagSyntaxError(f"Unexpected token at {position}")
+
+    return node
+
+def _parse_or(tokens, position):
+    node, position = _parse_and(tokens, position)
+    nodes = [node]
+    while position < len(tokens) and tokens[position][0] == "OR":
+        node, position = _parse_and(tokens, position + 1)
+        nodes.append(node)
+
+    return (nodes[0] if len(nodes) == 1 else ("or", nodes)), position
+
+def _parse_and(tokens, position):
+    node, position = _parse_not(tokens, position)
+    nodes = [node]
+    while position < len(tokens) and tokens[position][0] not in {"OR", ")"}:
+        if tokens[position][0] == "AND":
+            position = position + 1
+
+        node, position = _parse_not(tokens, position)
+        nodes.append(node)
+
+    return (nodes[0] if len(nodes) == 1 else ("and", nodes)), position
+
+def _parse_not(tokens, position):
+    if position >= len(tokens):
+        raise TagSyntaxError("Unexpected end of expression")
+
+    kind, value = tokens[position]
+    if kind == "NOT":
+        node, position = _parse_not(tokens, position + 1)
+        return ("not", node), position
+
+    if kind == "(":
+        node, position = _parse_or(tokens, position + 1)
+        if position >= len(tokens) or tokens[position][0] != ")":
+            raise TagSyntaxError("Missing closing parenthesis")
+
+        return node, position + 1
+
+    if kind == "tag":
+        return ("tag", value), position + 1
+
+    raise TagSyntaxError(f"Unexpected '{kind}' at {position}")
+
+"""
+e.g. compile_tags(("and", [("tag", "a"), ("not", ("tag", "b"))]))
+     -> ("SELECT * FROM (...) EXCEPT SELECT * FROM (...)", ("a", "b"))
+
+Compiles to one compound SELECT of note ids, each tag being a lookup on the
+tagmap(tag_id, note_id) index.
+"""
+def compile_tags(node):
+    kind = node[0]
+    if kind == "tag":
+        executor = ("SELECT note_id FROM tagmap WHERE tag_id IN "
+            "(SELECT id FROM tags WHERE tag = ?)")
+        return executor, (node[1],)
+
+    if kind == "not":
+        executor, values = compile_tags(node[1])
+        executor = f"SELECT id AS note_id FROM notes EXCEPT {_wrap(executor)}"
+        return executor, values
+
+    if kind == "or":
+        parts = [compile_tags(child) for child in node[1]]
+        executor = " UNION ".join(_wrap(part[0]) for part in parts)
+        return executor, sum((part[1] for part in parts), tuple())
+
+    include = [child for child in node[1] if child[0] != "not"]
+    exclude = [child[1] for child in node[1] if child[0] == "not"]
+
+    values = tuple()
+    executors = list()
+    for child in include:
+        child_executor, child_values = compile_tags(child)
+        executors.append(_wrap(child_executor))
+        values = values + child_values
+
+    executor = " INTERSECT ".join(executors)
+    if len(executors) == 0:
+        executor = "SELECT id AS note_id FROM notes"
+
+    for child in exclude:
+        child_executor, child_values = compile_tags(child)
+        executor = f"{executor} EXCEPT {_wrap(child_executor)}"
+        values = values + child_values
+
+    return executor, values
+
+def _wrap(executor):
+    return f"SELECT * FROM ({executor})"
+
+"""
+Note id lookups for tag expressions. With `cached` set, each tag's posting
+list of note ids is loaded once and expressions are answered with set
+operations in memory until `invalidate` is called by a tagmap write, or the
+write counts of the tables it reads show a write from anywhere else.
+
+e.g.
+    tag_index = TagIndex(db)
+    await tag_index.query("a AND b NOT c", after=0, limit=50)
+"""
+class TagIndex:
+    def __init__(self, db, cached=True):
+        self.db = db
+        self.cached = cached
+
+        self.postings = dict()
+        self.universe = None
+        self.generation = 0
+        self.version = None
+
+    def invalidate(self):
+        self.generation = self.generation + 1
+        self.postings.clear()
+        self.universe = None
+
+    async def query(self, expression, after=None, limit=None):
+        node = parse_tags(expression)
+        if not self.cached:
+            return await self._query_sql(node, after, limit)
+
+        # Unknown counts never match, so nothing is cached against them
+        version = await self.db.versions(TABLES)
+        if version != self.version or None in version:
+            self.invalidate()
+            self.version = version
+
+        matched = await self._evaluate(node)
+        if matched is None:
+            return None
+
+        ids = sorted(matched)
+        if after is not None:
+            ids = [note_id for note_id in ids if note_id > after]
+
+        return ids if limit is None else ids[:limit]
+
+    async def _query_sql(self, node, after, limit):
+        executor, values = compile_tags(node)
+        executor = f"SELECT note_id FROM ({executor}) WHERE note_id > ?"
+        executor = f"{executor} ORDER BY note_id"
+        values = values + (after if after is not None else -1,)
+        if limit is not None:
+            executor = f"{executor} LIMIT ?"
+            values = values + (limit,)
+
+        results = await self.db.read(SQLite.fetch, executor, values)
+        if results is False:
+            return None
+
+        return [result[0] for result in results]
+
+    # None when a read failed, which spreads up to `query`
+    async def _evaluate(self, node):
+        kind = node[0]
+        if kind == "tag":
+            return await self._posting(node[1])
+
+        if kind == "not":
+            universe = await self._universe()
+            excluded = await self._evaluate(node[1])
+            if universe is None or excluded is None:
+                return None
+
+            return universe - excluded
+
+        children = [await self._evaluate(child) for child in node[1]]
+        if None in children:
+            return None
+
+        if kind == "or":
+            return frozenset().union(*children)
+
+        # Smallest first keeps the intersection cheap
+        children.sort(key=len)
+        return children[0].intersection(*children[1:])
+
+    async def _posting(self, tag):
+        posting = self.postings.get(tag)
+        if posting is not None:
+            return posting
+
+        generation = self.generation
+        executor, values = compile_tags(("tag", tag))
+        results = await self.db.read(SQLite.fetch, executor, values)
+        if results is False:
+            return None
+
+        posting = frozenset(result[0] for result in results)
+
+        # A write may have landed while loading, only cache if it did not
+        if generation == self.generation:
+            self.postings[tag] = posting
+
+        return posting
+
+    async def _universe(self):
+        if self.universe is not None:
+            return self.universe
+
+        generation = self.generation
+        results = await self.db.read(SQLite.fetch, "SELECT id FROM notes")
+        if results is False:
+            return None
+
+        universe = frozenset(result[0] for result in results)
+        if generation == self.generation:
+            self.universe = universe
+
+        return universe
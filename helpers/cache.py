@@ -0,0 +1,71 @@
+from hashlib import blake2b
+from collections import defaultdict, OrderedDict
+
+"""
+Serialized responses keyed by (endpoint, table, query), each stored with the
+stamp it was built under. A stamp is the version counters of the tables the
+response reads, so bumping a table makes every entry built from it stale.
+Bodies over `max_entry` bytes are not kept, and the oldest entries go once
+the rest add up to more than `max_bytes`.
+
+e.g.
+    cache = ResponseCache()
+    stamp = cache.stamp(["tags"])
+    cache.put(("entries", "tags"), stamp, b"[]") -> '"5c1f..."'
+    cache.bump("tags")
+    cache.get(("entries", "tags"), cache.stamp(["tags"])) -> None
+"""
+class ResponseCache:
+    def __init__(self, size=1024, max_bytes=64 * 2 ** 20,
+        max_entry=2 ** 20):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.max_entry = max_entry
+        self.bytes = 0
+        self.versions = defaultdict(int)
+        self.entries = OrderedDict()
+
+    def bump(self, table):
+        self.versions[table] = self.versions[table] + 1
+
+    def stamp(self, tables, *extra):
+        return (*(self.versions[table] for table in tables), *extra)
+
+    def get(self, key, stamp):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] != stamp:
+            return None
+
+        self.entries.move_to_end(key)
+        return entry[1], entry[2]
+
+    def put(self, key, stamp, body):
+        etag = f'"{blake2b(body, digest_size=16).hexdigest()}"'
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.bytes = self.bytes - len(previous[2])
+
+        if len(body) > self.max_entry:
+            return etag
+
+        self.entries[key] = stamp, etag, body
+        self.bytes = self.bytes + len(body)
+        while len(self.entries) > self.size or self.bytes > self.max_bytes:
+            _, (_, _, evicted) = self.entries.popitem(last=False)
+            self.bytes = self.bytes - len(evicted)
+
+        return etag
+
+def etag_matches(etag, if_none_match):
+    if if_none_match is None:
+        return False
+
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+
+        if candidate == "*" or candidate == etag:
+            return True
+
+    return False
@@ -1,9 +1,46 @@
 from helpers.general import eprint
 from json import dump, dumps, loads
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import date, datetime
+
+# orjson is several times faster on large lists of rows, stdlib is the fallback
+try:
+    import orjson
+
+except ImportError:
+    orjson = None
+
+JSON_BACKEND = "json" if orjson is None else "orjson"
+
+# Fallback for values the JSON encoder does not know, such as timestamps
+def _default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON "
+        "serializable")
+
+# JSON encoder, converts a python object to UTF-8 bytes for response bodies
+def jotb(data):
+    if orjson is None:
+        encoded = jots(data)
+        return None if encoded is None else encoded.encode()
+
+    try:
+        return orjson.dumps(data, default=_default,
+            option=orjson.OPT_NON_STR_KEYS)
+
+    except TypeError as e:
+        return None
 
 # JSON encoder, converts a python object to a string
 def jots(data, readable=False, dest=None):
+    if orjson is not None and not readable and dest is None:
+        encoded = jotb(data)
+        return None if encoded is None else encoded.decode()
+
     kwargs = dict()
+    kwargs["default"] = _default
 
     # If readable is set, it pretty prints the JSON to be more human-readable
     if readable:
@@ -17,14 +54,30 @@ def jots(data, readable=False, dest=None):
 
         return dumps(data, ensure_ascii=False, **kwargs)
 
-    except ValueError as e:
+    except (ValueError, TypeError) as e:
         return None
 
 # JSON decoder, converts a string to a python object
 def jsto(data):
     try:
+        if orjson is not None:
+            return orjson.loads(data)
+
         return loads(data)
 
     except ValueError as e:
         eprint(e)
         return None
+
+# Opaque pagination cursor, converts a python object to a URL-safe token
+def encode_cursor(data):
+    return urlsafe_b64encode(jotb(data)).decode()
+
+# Pagination cursor decoder, returns None for a malformed token
+def decode_cursor(token):
+    try:
+        return jsto(urlsafe_b64decode(token.encode()))
+
+    except (ValueError, TypeError) as e:
+        eprint(e)
+        return None
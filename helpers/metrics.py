@@ -0,0 +1,160 @@
+from helpers.general import eprint
+
+from time import time
+from bisect import bisect_left
+from threading import Lock
+from collections import defaultdict, deque
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum = self.sum + value
+        self.count = self.count + 1
+
+    def render(self, name, labels):
+        lines = list()
+        cumulative = 0
+        for bound, count in zip((*self.buckets, "+Inf"), self.counts):
+            cumulative = cumulative + count
+            bucket = _labels({**labels, "le": str(bound)})
+            lines.append(f"{name}_bucket{bucket} {cumulative}")
+
+        lines.append(f"{name}_sum{_labels(labels)} {self.sum}")
+        lines.append(f"{name}_count{_labels(labels)} {self.count}")
+        return lines
+
+def _labels(labels):
+    if len(labels) == 0:
+        return ""
+
+    pairs = list()
+    for key, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n")
+        value = value.replace('"', '\\"')
+        pairs.append(f'{key}="{value}"')
+
+    return "{" + ",".join(pairs) + "}"
+
+"""
+Collects the `SQLite` instrumentation hooks and per-route request timings,
+rendered in the Prometheus text format. Statements are labelled by their
+SQL, which is a template with bound values, and past `max_statements`
+distinct ones new statements share the "other" label.
+
+Statements slower than `slow_threshold` seconds are logged through `eprint`
+and the last `slow_size` of them are kept in `slow`.
+
+e.g.
+    metrics = Metrics(slow_threshold=0.1)
+    metrics.attach(db)
+    metrics.render() -> '# TYPE epicure_query_seconds histogram\\n...'
+"""
+class Metrics:
+    def __init__(self, slow_threshold=0.1, slow_size=100,
+        max_statements=500):
+        self.slow_threshold = slow_threshold
+        self.max_statements = max_statements
+        self.lock = Lock()
+
+        self.queries = defaultdict(Histogram)
+        self.rows = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.lock_wait = Histogram()
+        self.transactions = defaultdict(Histogram)
+        self.routes = defaultdict(Histogram)
+        self.slow = deque(maxlen=slow_size)
+        self.slow_count = 0
+
+    def attach(self, db):
+        db.hook("statement", self.statement)
+        db.hook("lock", self.lock_acquired)
+        db.hook("transaction", self.transaction)
+
+    def statement(self, executor, seconds, rows, error=None):
+        executor = " ".join(executor.split())
+        with self.lock:
+            label = executor
+            if label not in self.queries:
+                if len(self.queries) >= self.max_statements:
+                    label = "other"
+
+            self.queries[label].observe(seconds)
+            self.rows[label] = self.rows[label] + rows
+            if error is not None:
+                key = label, type(error).__name__
+                self.errors[key] = self.errors[key] + 1
+
+            slow = seconds >= self.slow_threshold
+            if slow:
+                self.slow_count = self.slow_count + 1
+                entry = dict()
+                entry["at"] = time()
+                entry["seconds"] = seconds
+                entry["rows"] = rows
+                entry["statement"] = executor
+                self.slow.append(entry)
+
+        if slow:
+            eprint(f"Slow query ({seconds * 1000:.1f} ms, {rows} rows): "
+                f"{executor}")
+
+    def lock_acquired(self, seconds):
+        with self.lock:
+            self.lock_wait.observe(seconds)
+
+    def transaction(self, seconds, committed):
+        outcome = "commit" if committed else "rollback"
+        with self.lock:
+            self.transactions[outcome].observe(seconds)
+
+    def route(self, method, path, status, seconds):
+        with self.lock:
+            self.routes[method, path, status].observe(seconds)
+
+    def render(self):
+        lines = list()
+        with self.lock:
+            lines.append("# TYPE epicure_query_seconds histogram")
+            for statement, histogram in self.queries.items():
+                labels = {"statement": statement}
+                lines.extend(histogram.render("epicure_query_seconds",
+                    labels))
+
+            lines.append("# TYPE epicure_query_rows_total counter")
+            for statement, rows in self.rows.items():
+                labels = _labels({"statement": statement})
+                lines.append(f"epicure_query_rows_total{labels} {rows}")
+
+            lines.append("# TYPE epicure_query_errors_total counter")
+            for (statement, error), count in self.errors.items():
+                labels = _labels({"statement": statement, "error": error})
+                lines.append(f"epicure_query_errors_total{labels} {count}")
+
+            lines.append("# TYPE epicure_slow_queries_total counter")
+            lines.append(f"epicure_slow_queries_total {self.slow_count}")
+
+            lines.append("# TYPE epicure_lock_wait_seconds histogram")
+            lines.extend(self.lock_wait.render("epicure_lock_wait_seconds",
+                dict()))
+
+            lines.append("# TYPE epicure_transaction_seconds histogram")
+            for outcome, histogram in self.transactions.items():
+                lines.extend(histogram.render("epicure_transaction_seconds",
+                    {"outcome": outcome}))
+
+            lines.append("# TYPE epicure_request_seconds histogram")
+            for (method, path, status), histogram in self.routes.items():
+                labels = {"method": method, "route": path, "status": status}
+                lines.extend(histogram.render("epicure_request_seconds",
+                    labels))
+
+        return "\n".join(lines) + "\n"